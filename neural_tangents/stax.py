@@ -3035,7 +3035,7 @@ def ElementwiseNumerical(
       'tolerance level, required `deg` will highly be dependent on the choice'
       'of `fn`.')
 
-  quad_points = osp.special.roots_hermite(deg)
+  quad_points = _roots_hermite(deg)
 
   if df is None:
     warnings.warn(
@@ -3778,6 +3778,12 @@ def _elementwise(fn: Optional[Callable[[float], float]],
   return init_fn, apply_fn, new_kernel_fn
 
 
+@functools.lru_cache(maxsize=8)
+def _roots_hermite(deg: int) -> Tuple[onp.ndarray, onp.ndarray]:
+  """Cached Gauss-Hermite quadrature `(points, weights)` of degree `deg`."""
+  return osp.special.roots_hermite(deg)
+
+
 def _arccos(x, do_backprop):
   if do_backprop:
     # https://github.com/google/jax/issues/654
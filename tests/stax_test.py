@@ -15,30 +15,40 @@
 """Tests for stax.py."""
 
 
+import dataclasses
 import functools
+import hashlib
 import itertools
+import os
 import random as prandom
 import string
 import time
 from typing import Tuple
 
 from absl.testing import absltest
+import jax
 from jax import lax
 from jax import ops
 from jax import test_util as jtu
-from jax.api import jit, vjp
+from jax.api import eval_shape, jit, vjp
 from jax.config import config
 from jax.lib import xla_bridge
 import jax.numpy as np
 import jax.random as random
+from jax.tree_util import tree_map
 import more_itertools
 from neural_tangents import stax
 from neural_tangents.utils import monte_carlo, test_utils, utils, batch
 import numpy as onp
 
 
+# Kept at import time rather than under `__main__`: test runners such as
+# `pytest` import this module without running it, and both the flags (e.g.
+# `--num_generated_cases`, read while building parameterized cases below) and
+# the tolerances must be in place before any test is collected.
 config.parse_flags_with_absl()
 config.update('jax_numpy_rank_promotion', 'raise')
+test_utils.update_test_tolerance()
 
 
 MODELS = [
@@ -50,6 +60,8 @@ BATCH_SIZE = 4
 
 INPUT_SHAPE = (BATCH_SIZE, 8, 6, 2)
 
+_FC_INPUT_DIM = int(onp.prod(INPUT_SHAPE[1:]))
+
 WIDTHS = [2**10]
 
 N_SAMPLES = 100
@@ -72,8 +84,12 @@ STRIDES = [
     (2, 1),
 ]
 
+_RELU = stax.Relu()
+
+_RELU_STABILIZE = stax.Relu(do_stabilize=True)
+
 ACTIVATIONS = {
-    stax.Relu(): 'Relu',
+    _RELU: 'Relu',
 }
 
 PROJECTIONS = [
@@ -101,11 +117,62 @@ PARAMETERIZATIONS = [
     'STANDARD'
 ]
 
-test_utils.update_test_tolerance()
+_PLATFORM = xla_bridge.get_backend().platform
+
+_KEY = random.PRNGKey(1)
+
+_KEY_SPLIT = tuple(random.split(_KEY))
+
+_KEY_SPLIT_3 = tuple(random.split(_KEY, 3))
+
+# Opt-in: run Monte Carlo forward passes in `bfloat16` on accelerators to
+# halve memory traffic. Off by default, since it loosens the empirical kernels.
+_MC_BFLOAT16 = (os.environ.get('NT_TEST_MC_BFLOAT16', '0') == '1' and
+                _PLATFORM in ('tpu', 'gpu'))
+
+# Opt-in: directory to store Monte Carlo estimates of the slowest tests in, so
+# that later runs load them instead of resampling. Estimates are keyed by their
+# sampling settings and a hash of the library, test code and JAX version.
+_MC_CACHE_DIR = os.environ.get('NT_TEST_MC_CACHE_DIR')
+
+# Opt-in: also run `ConvLocalTest` Monte Carlo checks whose kernels are compared
+# exactly against `stax.Conv`. By default these only run for the 'standard'
+# parameterization, which still exercises `ConvLocal`'s `init_fn`/`apply_fn`.
+_RUN_MC = os.environ.get('NT_RUN_MC') == '1'
+
+_FILTER_SPECS = tuple(''.join(p) for p in itertools.permutations('HWIO'))
+
+_NCHW_SPECS = tuple(''.join(p) for p in itertools.permutations('NCHW'))
+
+# Keep batch dimension leading for TPU for batching to work.
+_NCHW_TPU_SPECS = tuple('N' + ''.join(p)
+                        for p in itertools.permutations('CHW'))
+
+# `(spec, indices)` pairs, where `indices` permute spatial sizes from the
+# default `HW` order into the `spec` order.
+_FILTER_SPEC_PERMS = tuple((spec, tuple('HW'.index(c) for c in spec
+                                        if c in 'HW'))
+                           for spec in _FILTER_SPECS)
+
+# `(spec, indices)` pairs, where `indices` permute `INPUT_SHAPE` from the
+# default `NHWC` order into the `spec` order.
+_NCHW_SPEC_PERMS = tuple((spec, tuple('NHWC'.index(c) for c in spec))
+                         for spec in _NCHW_SPECS)
+
+_NCHW_TPU_SPEC_PERMS = tuple((spec, tuple('NHWC'.index(c) for c in spec))
+                             for spec in _NCHW_TPU_SPECS)
+
+
+@functools.lru_cache(maxsize=None)
+def _attn_dims(width: int) -> Tuple[int, int]:
+  """Returns `(n_heads, n_chan_val)` of a `GlobalSelfAttention` layer."""
+  n_heads = int(onp.sqrt(width))
+  n_chan_val = int(onp.round(float(width) / n_heads))
+  return n_heads, n_chan_val
 
 
 def _skip_test(msg='Skipping large tests for speed.', platforms=('cpu',)):
-  if xla_bridge.get_backend().platform in platforms:
+  if _PLATFORM in platforms:
     raise absltest.SkipTest(msg)
 
 
@@ -123,36 +190,55 @@ def _get_inputs(
   return x1, x2
 
 
+@functools.lru_cache(maxsize=128)
+def _get_default_inputs(
+    same_inputs,
+    shape
+) -> Tuple[np.ndarray, np.ndarray]:
+  """Same as `_get_inputs(_KEY, ...)`, but only samples every `shape` once."""
+  return _get_inputs(_KEY, same_inputs, shape)
+
+
+# Standard-parameterized layers of `_get_net_pool`.
+_FC_STD = functools.partial(
+    stax.Dense, W_std=2.**0.5, b_std=0.5**0.5, parameterization='ntk')
+_CONV_STD = functools.partial(
+    stax.Conv,
+    filter_shape=(3, 2),
+    strides=None,
+    padding='SAME',
+    W_std=2.**0.5,
+    b_std=0.5**0.5,
+    parameterization='ntk')
+
+
 def _get_net(W_std, b_std, filter_shape, is_conv, use_pooling, is_res, padding,
              phi, strides, width, is_ntk, proj_into_2d, pool_type, layer_norm,
              parameterization, use_dropout):
+  # Seed the layout choices with the config, so that identical configs always
+  # get identical `dimension_numbers` (and hit the same compilation caches).
+  # A string seed is hashed deterministically, unlike `hash` of a tuple.
+  rng = prandom.Random(repr((is_conv, filter_shape, padding, strides, width,
+                             is_ntk, proj_into_2d, pool_type, parameterization,
+                             _PLATFORM)))
 
   if is_conv:
     # Select a random filter order.
-    default_filter_spec = 'HW'
-    filter_specs = [''.join(p) for p in itertools.permutations('HWIO')]
-    filter_spec = prandom.choice(filter_specs)
-    filter_shape = tuple(filter_shape[default_filter_spec.index(c)]
-                         for c in filter_spec if c in default_filter_spec)
-    strides = tuple(strides[default_filter_spec.index(c)]
-                    for c in filter_spec if c in default_filter_spec)
+    filter_spec, idx = rng.choice(_FILTER_SPEC_PERMS)
+    filter_shape = tuple(filter_shape[i] for i in idx)
+    strides = tuple(strides[i] for i in idx)
 
     # Select the activation order.
-    default_spec = 'NHWC'
-    if xla_bridge.get_backend().platform == 'tpu':
-      # Keep batch dimension leading for TPU for batching to work.
-      specs = ['N' + ''.join(p) for p in itertools.permutations('CHW')]
-    else:
-      specs = [''.join(p) for p in itertools.permutations('NCHW')]
-    spec = prandom.choice(specs)
-    input_shape = tuple(INPUT_SHAPE[default_spec.index(c)] for c in spec)
+    spec, idx = rng.choice(_NCHW_TPU_SPEC_PERMS if _PLATFORM == 'tpu' else
+                           _NCHW_SPEC_PERMS)
+    input_shape = tuple(INPUT_SHAPE[i] for i in idx)
 
   else:
-    input_shape = (INPUT_SHAPE[0], onp.prod(INPUT_SHAPE[1:]))
-    if xla_bridge.get_backend().platform == 'tpu':
+    input_shape = (INPUT_SHAPE[0], _FC_INPUT_DIM)
+    if _PLATFORM == 'tpu':
       spec = 'NC'
     else:
-      spec = prandom.choice(['NC', 'CN'])
+      spec = rng.choice(['NC', 'CN'])
       if spec.index('N') == 1:
         input_shape = input_shape[::-1]
 
@@ -236,8 +322,7 @@ def _get_net(W_std, b_std, filter_shape, is_conv, use_pooling, is_res, padding,
   elif proj_into_2d == 'POOL':
     proj_layer = global_pool_fn(batch_axis, channel_axis)
   elif proj_into_2d.startswith('ATTN'):
-    n_heads = int(np.sqrt(width))
-    n_chan_val = int(np.round(float(width) / n_heads))
+    n_heads, n_chan_val = _attn_dims(width)
     proj_layer = stax.serial(
         stax.GlobalSelfAttention(
             n_chan_out=width,
@@ -263,20 +348,9 @@ def _get_net(W_std, b_std, filter_shape, is_conv, use_pooling, is_res, padding,
 
 def _get_net_pool(width, is_ntk, pool_type, padding,
                   filter_shape, strides, normalize_edges):
-  W_std, b_std = 2.**0.5, 0.5**0.5
-  phi = stax.Relu()
-  parameterization = 'ntk'
-
-  fc = functools.partial(
-      stax.Dense, W_std=W_std, b_std=b_std, parameterization=parameterization)
-  conv = functools.partial(
-      stax.Conv,
-      filter_shape=(3, 2),
-      strides=None,
-      padding='SAME',
-      W_std=W_std,
-      b_std=b_std,
-      parameterization=parameterization)
+  phi = _RELU
+  fc = _FC_STD
+  conv = _CONV_STD
 
   if pool_type == 'AVG':
     pool_fn = functools.partial(stax.AvgPool, normalize_edges=normalize_edges)
@@ -294,33 +368,178 @@ def _get_net_pool(width, is_ntk, pool_type, padding,
       fc(1 if is_ntk else width)), INPUT_SHAPE, -1, -1
 
 
+def _get_output_shape(init_fn, key, input_shape):
+  """Returns the output shape of `init_fn` without computing parameters."""
+  output_shape = []
+
+  def init_params(key):
+    shape, params = init_fn(key, input_shape)
+    output_shape.append(shape)
+    return params
+
+  eval_shape(init_params, key)
+  return output_shape[0]
+
+
+def _bfloat16_apply_fn(apply_fn):
+  """Wraps `apply_fn` to compute in `bfloat16` and return `float32` outputs."""
+  to_bfloat16 = lambda x: x.astype(np.bfloat16)
+
+  def apply_fn_bfloat16(params, inputs, **kwargs):
+    outputs = apply_fn(tree_map(to_bfloat16, params),
+                       tree_map(to_bfloat16, inputs),
+                       **kwargs)
+    return tree_map(lambda x: x.astype(np.float32), outputs)
+
+  return apply_fn_bfloat16
+
+
+def _get_mc_apply_fn(apply_fn):
+  """Returns `apply_fn` to sample Monte Carlo estimates with."""
+  return _bfloat16_apply_fn(apply_fn) if _MC_BFLOAT16 else apply_fn
+
+
+def _get_empirical_kernel_fn(init_fn, apply_fn, n_samples, device_count,
+                             channel_axis, batch_size):
+  """Returns a Monte Carlo kernel function of `StaxTest` networks."""
+  return monte_carlo.monte_carlo_kernel_fn(
+      init_fn, _get_mc_apply_fn(apply_fn), _KEY, n_samples,
+      device_count=device_count, trace_axes=(channel_axis,),
+      batch_size=batch_size, implementation=2)
+
+
+_MC_CHUNK = 32
+
+# Minimum number of chunks to estimate the Monte Carlo standard error from.
+_MC_MIN_CHUNKS = 4
+
+
+def _mc_chunks(n_samples):
+  """Sample counts at which chunked Monte Carlo samplers yield estimates."""
+  return range(_MC_CHUNK, n_samples + 1, _MC_CHUNK)
+
+
+def _get_converged_mc_kernel(kernel_fn_mc, n_samples, x1, x2, get, tol,
+                             **kwargs):
+  """Returns a Monte Carlo estimate, stopping once it is accurate enough.
+
+  Args:
+    kernel_fn_mc: a generator Monte Carlo kernel function, constructed with
+      `n_samples=_mc_chunks(n_samples)`.
+    n_samples: maximum number of samples.
+    x1: first inputs.
+    x2: second inputs.
+    get: a single kernel to sample.
+    tol: relative tolerance the estimate will be tested with. Sampling stops
+      once the estimated relative standard error of the mean falls below
+      `tol / 3`, or after all `n_samples`. The error is only estimated after
+      at least `_MC_MIN_CHUNKS` chunks and half of `n_samples`.
+    **kwargs: passed to `kernel_fn_mc`.
+
+  Returns:
+    The Monte Carlo estimate of the kernel.
+  """
+  n_prev, estimate_prev = 0, 0.
+  n_chunks, mean, m2 = 0, 0., 0.
+  estimates = kernel_fn_mc(x1, x2, get=get, **kwargs)
+  for n, estimate in zip(_mc_chunks(n_samples), estimates):
+    # Welford update of moments of per-chunk means.
+    chunk = (n * estimate - n_prev * estimate_prev) / (n - n_prev)
+    n_prev, estimate_prev = n, estimate
+    n_chunks += 1
+    delta = chunk - mean
+    mean += delta / n_chunks
+    m2 += delta * (chunk - mean)
+
+    if n_chunks >= _MC_MIN_CHUNKS and 2 * n >= n_samples:
+      stderr = np.sqrt(m2 / (n_chunks - 1) / n_chunks)
+      if (np.linalg.norm(stderr) <
+          tol / 3 * np.maximum(np.linalg.norm(estimate), 1e-12)):
+        break
+
+  return estimate_prev
+
+
+@functools.lru_cache(maxsize=None)
+def _get_mc_cache_version():
+  """Returns a hash of the JAX version and the `neural_tangents` and test code.
+
+  Part of every `_get_cached_mc_kernel` key, so that any change to the library,
+  the networks defined in this file, or JAX invalidates cached estimates.
+  """
+  h = hashlib.sha1(
+      f'{jax.__version__}-{_PLATFORM}-{_MC_BFLOAT16}'.encode())
+  paths = [os.path.abspath(__file__)]
+  for root, _, files in os.walk(os.path.dirname(stax.__file__)):
+    paths += [os.path.join(root, f) for f in files if f.endswith('.py')]
+  for path in sorted(paths):
+    with open(path, 'rb') as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+
+def _get_cached_mc_kernel(test_id, params, sample_fn):
+  """Returns `sample_fn()`, cached on disk in `_MC_CACHE_DIR` if it is set.
+
+  Args:
+    test_id: id of the calling test.
+    params: a tuple of all sampling settings not encoded in `test_id` (e.g.
+      `width` and `n_samples`).
+    sample_fn: a function computing the Monte Carlo estimate.
+
+  Returns:
+    The (possibly cached) Monte Carlo estimate.
+  """
+  if _MC_CACHE_DIR is None:
+    return sample_fn()
+
+  name = hashlib.sha1(
+      f'{test_id}-{params!r}-{_get_mc_cache_version()}'.encode()).hexdigest()
+  path = os.path.join(_MC_CACHE_DIR, f'{name}.npy')
+  if os.path.exists(path):
+    return np.asarray(onp.load(path))
+
+  kernel = sample_fn()
+  os.makedirs(_MC_CACHE_DIR, exist_ok=True)
+  onp.save(path, onp.asarray(kernel))
+  return kernel
+
+
+@functools.partial(jit, static_argnums=(2,))
+def _mask_and_sort(x, mask_constant, mask_axis, key, p):
+  mask_shape = tuple(1 if i in mask_axis else s
+                     for i, s in enumerate(x.shape))
+  mask = random.bernoulli(key, p=p, shape=mask_shape)
+  x = np.where(mask, mask_constant, x)
+  return lax.sort(x, dimension=1)
+
+
 def _mask(x, mask_constant, mask_axis, key, p):
   if mask_constant is not None:
-    mask_shape = [1 if i in mask_axis else s
-                  for i, s in enumerate(x.shape)]
-    mask = random.bernoulli(key, p=p, shape=mask_shape)
-    x = np.where(mask, mask_constant, x)
-    x = np.sort(x, 1)
+    x = _mask_and_sort(x, mask_constant, frozenset(mask_axis), key, p)
   return x
 
 
-class StaxTest(test_utils.NeuralTangentsTestCase):
+def _is_valid_net(filter_shape, is_conv, is_res, padding, proj_into_2d,
+                  strides, use_pooling):
+  """Filters out duplicate / incorrectly-shaped NN configs / wrong backend."""
+  if is_conv:
+    # Not running CNN models on CPU to save time.
+    if _PLATFORM == 'cpu':
+      return False
 
-  def _skip_test(self, filter_shape, is_conv, is_res, padding, proj_into_2d,
-                 strides, use_pooling):
-    if is_conv:
-      if xla_bridge.get_backend().platform == 'cpu':
-        raise absltest.SkipTest('Not running CNN models on CPU to save time.')
-
-      if (is_res and is_conv and ((strides is not None and strides != (1, 1)) or
-                                  (padding == 'VALID' and filter_shape !=
-                                   (1, 1)))):
-        raise absltest.SkipTest('Different paths in a residual models need to '
-                                'return outputs of the same shape.')
-    elif (filter_shape != FILTER_SHAPES[0] or padding != PADDINGS[0] or
-          strides != STRIDES[0] or proj_into_2d != PROJECTIONS[0] or
-          use_pooling):
-      raise absltest.SkipTest('FC models do not have these parameters.')
+    # Different paths in a residual models need to return outputs of the same
+    # shape.
+    return not (is_res and ((strides is not None and strides != (1, 1)) or
+                            (padding == 'VALID' and filter_shape != (1, 1))))
+
+  # FC models do not have these parameters.
+  return (filter_shape == FILTER_SHAPES[0] and padding == PADDINGS[0] and
+          strides == STRIDES[0] and proj_into_2d == PROJECTIONS[0] and
+          not use_pooling)
+
+
+class StaxTest(test_utils.NeuralTangentsTestCase):
 
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
@@ -364,15 +583,13 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
                           for use_pooling in [False, True]
                           for is_ntk in [False, True]
                           for is_res in [False, True]
-                          for proj_into_2d in PROJECTIONS))
+                          for proj_into_2d in PROJECTIONS
+                          if _is_valid_net(filter_shape, 'conv' in model,
+                                           is_res, padding, proj_into_2d,
+                                           strides, use_pooling)))
   def test_exact(self, model, width, strides, padding, phi, same_inputs,
                  filter_shape, use_pooling, is_ntk, is_res, proj_into_2d):
     is_conv = 'conv' in model
-
-    # Check for duplicate / incorrectly-shaped NN configs / wrong backend.
-    self._skip_test(filter_shape, is_conv, is_res, padding, proj_into_2d,
-                    strides, use_pooling)
-
     pool_type = 'AVG'
     W_std, b_std = 2.**0.5, 0.5**0.5
     layer_norm = None
@@ -413,7 +630,10 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
                           for is_ntk in [False, True]
                           for filter_shape in FILTER_SHAPES
                           for proj_into_2d in PROJECTIONS[:2]
-                          for parameterization in PARAMETERIZATIONS))
+                          for parameterization in PARAMETERIZATIONS
+                          if _is_valid_net(FILTER_SHAPES[0], 'conv' in model,
+                                           False, PADDINGS[0], proj_into_2d,
+                                           STRIDES[0], False)))
   def test_parameterizations(self, model, width, same_inputs, is_ntk,
                              filter_shape, proj_into_2d, parameterization):
     is_conv = 'conv' in model
@@ -421,19 +641,12 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
     W_std, b_std = 2.**0.5, 0.5**0.5
     padding = PADDINGS[0]
     strides = STRIDES[0]
-    phi = stax.Relu()
+    phi = _RELU
     use_pooling, is_res = False, False
     layer_norm = None
     pool_type = 'AVG'
     use_dropout = False
 
-    # Check for duplicate / incorrectly-shaped NN configs / wrong backend.
-    if is_conv:
-      if xla_bridge.get_backend().platform == 'cpu':
-        raise absltest.SkipTest('Not running CNN models on CPU to save time.')
-    elif proj_into_2d != PROJECTIONS[0]:
-      raise absltest.SkipTest('FC models do not have these parameters.')
-
     net = _get_net(W_std, b_std, filter_shape, is_conv, use_pooling, is_res,
                    padding, phi, strides, width, is_ntk, proj_into_2d,
                    pool_type, layer_norm, parameterization, use_dropout)
@@ -467,7 +680,11 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
                           for same_inputs in [False]
                           for is_ntk in [False, True]
                           for proj_into_2d in PROJECTIONS[:2]
-                          for layer_norm in LAYER_NORM))
+                          for layer_norm in LAYER_NORM
+                          if _is_valid_net(FILTER_SHAPES[0], 'conv' in model,
+                                           False, PADDINGS[0], proj_into_2d,
+                                           STRIDES[0], False)
+                          if 'conv' in model or layer_norm in ('C', 'NC')))
   def test_layernorm(self,
                      model,
                      width,
@@ -476,18 +693,11 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
                      proj_into_2d,
                      layer_norm):
     is_conv = 'conv' in model
-    # Check for duplicate / incorrectly-shaped NN configs / wrong backend.
-    if is_conv:
-      if xla_bridge.get_backend().platform == 'cpu':
-        raise absltest.SkipTest('Not running CNN models on CPU to save time.')
-    elif proj_into_2d != PROJECTIONS[0] or layer_norm not in ('C', 'NC'):
-      raise absltest.SkipTest('FC models do not have these parameters.')
-
     W_std, b_std = 2.**0.5, 0.5**0.5
     filter_shape = FILTER_SHAPES[0]
     padding = PADDINGS[0]
     strides = STRIDES[0]
-    phi = stax.Relu()
+    phi = _RELU
     use_pooling, is_res = False, False
     parameterization = 'ntk'
     pool_type = 'AVG'
@@ -529,15 +739,15 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
                           for pool_type in POOL_TYPES for padding in PADDINGS
                           for filter_shape in FILTER_SHAPES
                           for strides in STRIDES
-                          for normalize_edges in [True, False]))
+                          for normalize_edges in [True, False]
+                          # `normalize_edges` not applicable to `SumPool`.
+                          if not (pool_type == 'SUM' and normalize_edges)))
   def test_pool(self, width, same_inputs, is_ntk, pool_type,
                 padding, filter_shape, strides, normalize_edges):
     use_dropout = False
     # Check for duplicate / incorrectly-shaped NN configs / wrong backend.
-    if xla_bridge.get_backend().platform == 'cpu':
+    if _PLATFORM == 'cpu':
       raise absltest.SkipTest('Not running CNN models on CPU to save time.')
-    if pool_type == 'SUM' and normalize_edges:
-      raise absltest.SkipTest('normalize_edges not applicable to SumPool.')
 
     net = _get_net_pool(width, is_ntk, pool_type,
                         padding, filter_shape, strides, normalize_edges)
@@ -553,14 +763,15 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
                                                     normalize_edges=True)
     _, apply_fn_stax = stax.ostax.AvgPool((2, 2), (1, 1), 'SAME')
 
-    out1 = apply_fn((), X1)
-    out2 = apply_fn((), X2)
-
-    out1_norm = apply_fn_norm((), X1)
-    out2_norm = apply_fn_norm((), X2)
+    # Pooling acts on each batch element independently, so evaluate all three
+    # layers on both inputs at once and split the results afterwards.
+    @jit
+    def apply_all(x):
+      return apply_fn((), x), apply_fn_norm((), x), apply_fn_stax((), x)
 
-    out1_stax = apply_fn_stax((), X1)
-    out2_stax = apply_fn_stax((), X2)
+    outs = apply_all(np.concatenate([X1, X2]))
+    (out1, out2), (out1_norm, out2_norm), (out1_stax, out2_stax) = [
+        np.split(out, [X1.shape[0]]) for out in outs]
 
     self.assertAllClose((out1_stax, out2_stax), (out1_norm, out2_norm))
 
@@ -626,7 +837,10 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
                           for filter_shape in [(2, 1)]
                           for is_ntk in [True, False]
                           for use_pooling in [True, False]
-                          for proj_into_2d in ['FLAT', 'POOL']))
+                          for proj_into_2d in ['FLAT', 'POOL']
+                          if _is_valid_net(filter_shape, 'conv' in model,
+                                           False, padding, proj_into_2d,
+                                           strides, use_pooling)))
   def test_dropout(self, model, width, same_inputs, is_ntk, padding, strides,
                    filter_shape, phi, use_pooling, proj_into_2d):
     pool_type = 'AVG'
@@ -636,9 +850,6 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
     W_std, b_std = 2.**0.5, 0.5**0.5
     layer_norm = None
     parameterization = 'ntk'
-    # Check for duplicate / incorrectly-shaped NN configs / wrong backend.
-    self._skip_test(filter_shape, is_conv, is_res, padding, proj_into_2d,
-                    strides, use_pooling)
 
     net = _get_net(W_std, b_std, filter_shape, is_conv, use_pooling, is_res,
                    padding, phi, strides, width, is_ntk, proj_into_2d,
@@ -660,7 +871,7 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
     if do_stabilize and act != 'relu':
       raise absltest.SkipTest('Stabilization possible only in Relu.')
 
-    key = random.PRNGKey(1)
+    key = _KEY
 
     input_count = 4
     sparse_count = 2
@@ -670,7 +881,7 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
     # NOTE(schsam): It seems that convergence is slower when inputs are sparse.
     samples = N_SAMPLES
 
-    if xla_bridge.get_backend().platform == 'gpu':
+    if _PLATFORM == 'gpu':
       jtu._default_tolerance[onp.dtype(onp.float64)] = 5e-4
       samples = 100 * N_SAMPLES
     else:
@@ -681,8 +892,10 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
     x_dense = random.normal(key, (input_count, input_size))
     x_sparse = ops.index_update(x_dense, ops.index[:sparse_count, :], 0.)
 
-    activation = (stax.Relu(do_stabilize=do_stabilize) if act == 'relu'
-                  else stax.Erf())
+    if act == 'relu':
+      activation = _RELU_STABILIZE if do_stabilize else _RELU
+    else:
+      activation = stax.Erf()
 
     init_fn, apply_fn, kernel_fn = stax.serial(
         stax.Dense(width),
@@ -769,43 +982,99 @@ class StaxTest(test_utils.NeuralTangentsTestCase):
      input_shape, device_count, channel_axis) = net
 
     num_samples = N_SAMPLES * 5 if use_dropout else N_SAMPLES
-    key = random.PRNGKey(1)
-    x1, x2 = _get_inputs(key, same_inputs, input_shape)
-    if xla_bridge.get_backend().platform == 'tpu' and use_dropout:
+    key = _KEY
+    x1, x2 = _get_default_inputs(same_inputs, input_shape)
+    if _PLATFORM == 'tpu' and use_dropout:
       # including a test case for tpu + dropout with (parallel + batching)
       batch_size = 2
     else:
       batch_size = 0
-    x1_out_shape, params = init_fn(key, x1.shape)
+    x1_out_shape = _get_output_shape(init_fn, key, x1.shape)
     if same_inputs:
       assert x2 is None
     if x2 is None:
       x2_out_shape = x1_out_shape
     else:
-      x2_out_shape, params = init_fn(key, x2.shape)
-    del params
+      x2_out_shape = _get_output_shape(init_fn, key, x2.shape)
 
     def _get_empirical(n_samples, get):
-      kernel_fn_empirical = monte_carlo.monte_carlo_kernel_fn(
-          init_fn, apply_fn, key, n_samples, device_count=device_count,
-          trace_axes=(channel_axis,), batch_size=batch_size,
-          implementation=2
-      )
+      kernel_fn_empirical = _get_empirical_kernel_fn(
+          init_fn, apply_fn, n_samples, device_count, channel_axis, batch_size)
       if same_inputs:
         assert x2 is None
       return kernel_fn_empirical(x1, x2, get)
 
-    if is_ntk:
-      exact, shape1, shape2 = kernel_fn(x1, x2, ('ntk', 'shape1', 'shape2'))
-      empirical = _get_empirical(num_samples, 'ntk')
-    else:
-      exact, shape1, shape2 = kernel_fn(x1, x2, ('nngp', 'shape1', 'shape2'))
-      empirical = _get_empirical(num_samples, 'nngp')
+    get = 'ntk' if is_ntk else 'nngp'
+    exact, shape1, shape2 = kernel_fn(x1, x2, (get, 'shape1', 'shape2'))
+    empirical = _get_empirical(num_samples, get)
     test_utils.assert_close_matrices(self, exact, empirical, rtol)
     self.assertEqual(shape1, x1_out_shape)
     self.assertEqual(shape2, x2_out_shape)
 
 
+@functools.lru_cache(maxsize=None)
+def _get_activation(phi_name, *args):
+  """Memoized `stax.<phi_name>(*args)`."""
+  return getattr(stax, phi_name)(*args)
+
+
+def _activation_net(activation_fn, model, output_dim, W_std, b_std):
+  """Returns an `ActivationTest` net."""
+  if model == 'fc':
+    affine = stax.Dense(1024, W_std, b_std)
+    readout = stax.Dense(output_dim)
+    depth = 1
+
+  else:
+    affine = stax.Conv(1024, (3, 2), W_std=W_std, b_std=b_std, padding='SAME')
+    readout = stax.serial(stax.GlobalAvgPool() if 'pool' in model else
+                          stax.Flatten(),
+                          stax.Dense(output_dim))
+    depth = 2
+
+  return stax.serial(*[affine, activation_fn]*depth, readout)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_activation_net(activation_fn, model, output_dim, W_std, b_std):
+  """Returns an `ActivationTest` net, with `kernel_fn` jitted."""
+  init_fn, apply_fn, kernel_fn = _activation_net(activation_fn, model,
+                                                 output_dim, W_std, b_std)
+  return init_fn, apply_fn, jit(kernel_fn, static_argnums=(2,))
+
+
+@functools.lru_cache(maxsize=None)
+def _get_activation_kernel_fn_abc(phi_name, model, output_dim, W_std, b_std):
+  """Returns a jitted `kernel_fn(x1, x2, get, abc)` of an `ActivationTest` net.
+
+  The activation is `stax.<phi_name>(*abc)`, with `abc` traced, so that the
+  kernel is compiled once for all `(a, b, c)` of a given architecture.
+  """
+  @functools.partial(jit, static_argnums=(2,))
+  def kernel_fn(x1, x2, get, abc):
+    activation_fn = getattr(stax, phi_name)(*abc)
+    _, _, kernel_fn = _activation_net(activation_fn, model, output_dim, W_std,
+                                      b_std)
+    return kernel_fn(x1, x2, get)
+
+  return kernel_fn
+
+
+@functools.lru_cache(maxsize=None)
+def _get_activation_mc_kernel_fn(init_fn, apply_fn, num_samplings):
+  """Returns a Monte Carlo kernel function of an `ActivationTest` net."""
+  _, split = _KEY_SPLIT
+  return monte_carlo.monte_carlo_kernel_fn(
+      init_fn, apply_fn, split, num_samplings, implementation=2,
+      vmap_axes=0
+  )
+
+
+@jit
+def _rbf_kernel(cov1, cov2, nngp, c):
+  return np.exp(c * (cov1 + cov2 - 2 * nngp))
+
+
 class ActivationTest(test_utils.NeuralTangentsTestCase):
 
   @stax.layer
@@ -824,25 +1093,23 @@ class ActivationTest(test_utils.NeuralTangentsTestCase):
 
       input_dim = kernels.shape1[1]
       cov1 = kernels.cov1
-      cov1 = np.reshape(cov1, (cov1.shape[0], 1))
       cov2 = cov1 if kernels.cov2 is None else kernels.cov2
-      cov2 = np.reshape(cov2, (1, cov2.shape[0]))
+      cov1 = np.expand_dims(cov1, 1)
+      cov2 = np.expand_dims(cov2, 0)
       nngp = kernels.nngp
 
       # TODO(schsam): Update cov1 and cov2 if we want to compose this kernel
       # with other kernels.
       return kernels.replace(
-          nngp=np.exp(-input_dim * gamma * (cov1 + cov2 - 2 * nngp)))
+          nngp=_rbf_kernel(cov1, cov2, nngp, -input_dim * gamma))
     return init_fn, apply_fn, kernel_fn
 
   def _test_activation(self, activation_fn, same_inputs, model, get,
-                       rbf_gamma=None):
-    platform = xla_bridge.get_backend().platform
-    if platform == 'cpu' and 'conv' in model:
+                       rbf_gamma=None, abc=None):
+    if _PLATFORM == 'cpu' and 'conv' in model:
       raise absltest.SkipTest('Not running CNNs on CPU to save time.')
 
-    key = random.PRNGKey(1)
-    key, split = random.split(key)
+    key, split = _KEY_SPLIT
     output_dim = 2048 if get == 'nngp' else 1
     b_std = 0.5
     W_std = 2.0
@@ -856,34 +1123,29 @@ class ActivationTest(test_utils.NeuralTangentsTestCase):
       rtol = 0.05
       X0_1 = random.normal(key, (6, 7))
       X0_2 = None if same_inputs else random.normal(split, (10, 7))
-      affine = stax.Dense(1024, W_std, b_std)
-      readout = stax.Dense(output_dim)
-      depth = 1
 
     else:
       rtol = 0.1
       X0_1 = random.normal(key, (4, 8, 8, 3))
       X0_2 = None if same_inputs else random.normal(split, (6, 8, 8, 3))
-      affine = stax.Conv(1024, (3, 2), W_std=W_std, b_std=b_std, padding='SAME')
-      readout = stax.serial(stax.GlobalAvgPool() if 'pool' in model else
-                            stax.Flatten(),
-                            stax.Dense(output_dim))
-      depth = 2
 
-    if platform == 'cpu':
+    if _PLATFORM == 'cpu':
       num_samplings = 200
       rtol *= 2
     else:
       num_samplings = (500 if activation_fn[2].__name__ in ('Sin', 'Rbf')
                        else 300)
 
-    init_fn, apply_fn, kernel_fn = stax.serial(
-        *[affine, activation_fn]*depth, readout)
-    analytic_kernel = kernel_fn(X0_1, X0_2, get)
-    mc_kernel_fn = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, split, num_samplings, implementation=2,
-        vmap_axes=0
-    )
+    init_fn, apply_fn, kernel_fn = _get_activation_net(
+        activation_fn, model, output_dim, W_std, b_std)
+    if abc is None:
+      analytic_kernel = kernel_fn(X0_1, X0_2, get)
+    else:
+      kernel_fn_abc = _get_activation_kernel_fn_abc(
+          activation_fn[2].__name__, model, output_dim, W_std, b_std)
+      analytic_kernel = kernel_fn_abc(X0_1, X0_2, get, np.array(abc))
+    mc_kernel_fn = _get_activation_mc_kernel_fn(init_fn, apply_fn,
+                                                num_samplings)
     empirical_kernel = mc_kernel_fn(X0_1, X0_2, get)
     test_utils.assert_close_matrices(self, analytic_kernel,
                                      empirical_kernel, rtol)
@@ -923,23 +1185,21 @@ class ActivationTest(test_utils.NeuralTangentsTestCase):
                               [1.5, 0.3],
                               [0., -np.pi/4., np.pi/2.])))
   def test_activation(self, same_inputs, model, phi_name, get, abc):
-    platform = xla_bridge.get_backend().platform
-    if platform == 'cpu':
+    if _PLATFORM == 'cpu':
       if abc != [0.3, 1.5, -np.pi/4]:
         raise absltest.SkipTest('Skipping Activation test on CPU to save time.')
 
     a, b, c = abc
-    if phi_name == 'Sin':
-      activation = stax.Sin(a=a, b=b, c=c)
-    elif phi_name == 'Erf':
-      activation = stax.Erf(a=a, b=b, c=c)
+    if phi_name in ('Sin', 'Erf'):
+      activation = _get_activation(phi_name, a, b, c)
     elif phi_name == 'Gelu':
-      activation = stax.Gelu()
+      activation = _get_activation(phi_name)
       if a != 1. or b != 1. or c != 0.:
         absltest.SkipTest('Skip `Gelu` test if (a, b, c) != (1., 1., 0.).')
     else:
       raise absltest.SkipTest(f'Activation {phi_name} is not implemented.')
-    self._test_activation(activation, same_inputs, model, get)
+    self._test_activation(activation, same_inputs, model, get,
+                          abc=None if phi_name == 'Gelu' else abc)
 
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
@@ -962,7 +1222,7 @@ class ActivationTest(test_utils.NeuralTangentsTestCase):
                           for gamma in [1e-6, 1e-4, 1e-2, 1.0, 2.]
                           ))
   def test_rbf(self, same_inputs, model, get, gamma):
-    activation = stax.Rbf(gamma)
+    activation = _get_activation('Rbf', gamma)
     self._test_activation(activation, same_inputs, model, get,
                           rbf_gamma=gamma)
 
@@ -991,11 +1251,10 @@ class ElementwiseNumericalTest(test_utils.NeuralTangentsTestCase):
                           for same_inputs in [False, True]
                           for get in ['nngp', 'ntk']))
   def test_elementwise_numerical(self, same_inputs, model, phi, get):
-    platform = xla_bridge.get_backend().platform
-    if platform == 'cpu' and 'conv' in model:
+    if _PLATFORM == 'cpu' and 'conv' in model:
       raise absltest.SkipTest('Not running CNNs on CPU to save time.')
 
-    key, split = random.split(random.PRNGKey(1))
+    key, split = _KEY_SPLIT
 
     output_dim = 1
     b_std = 0.01
@@ -1004,7 +1263,7 @@ class ElementwiseNumericalTest(test_utils.NeuralTangentsTestCase):
     deg = 25
     if get == 'ntk':
       rtol *= 2
-    if xla_bridge.get_backend().platform == 'tpu':
+    if _PLATFORM == 'tpu':
       rtol *= 2
 
     if model == 'fc':
@@ -1034,6 +1293,23 @@ class ElementwiseNumericalTest(test_utils.NeuralTangentsTestCase):
                                      numerical_activation_kernel, rtol)
 
 
+@functools.lru_cache(maxsize=32)
+def _normal(seed, shape):
+  """Memoized `random.normal(random.PRNGKey(seed), shape)`."""
+  return random.normal(random.PRNGKey(seed), shape)
+
+
+_AB_RELU_FC = stax.Dense(10, 1, 0)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_ab_relu_params():
+  """Parameters of `stax.serial(_AB_RELU_FC, <activation>)` on `(-1, 7)`."""
+  init_fn, _, _ = stax.serial(_AB_RELU_FC, stax.Identity())
+  _, params = init_fn(_KEY, input_shape=(-1, 7))
+  return params
+
+
 @jtu.parameterized.parameters([
     {
         'same_inputs': True,
@@ -1055,39 +1331,47 @@ class ElementwiseNumericalTest(test_utils.NeuralTangentsTestCase):
 class ABReluTest(test_utils.NeuralTangentsTestCase):
 
   def test_ab_relu_relu(self, same_inputs, do_stabilize):
-    key = random.PRNGKey(1)
-    X0_1 = random.normal(key, (5, 7))
-    fc = stax.Dense(10, 1, 0)
+    X0_1 = _normal(1, (5, 7))
+    fc = _AB_RELU_FC
 
     # Test that ABRelu(0, 1) == ReLU
-    init_fn, apply_relu, kernel_fn_relu = stax.serial(fc, stax.Relu())
-    _, params = init_fn(key, input_shape=(-1, 7))
+    _, apply_relu, kernel_fn_relu = stax.serial(fc, stax.Relu())
+    params = _get_ab_relu_params()
 
-    X0_2 = None if same_inputs else random.normal(key, (9, 7))
+    X0_2 = None if same_inputs else _normal(1, (9, 7))
 
-    for a, b in [(0, 1), (0, -1), (-1, 0), (1, 0)]:
-      with self.subTest(a=a, b=b):
-        _, apply_ab_relu, kernel_fn_ab_relu = stax.serial(
-            fc, stax.ABRelu(a, b, do_stabilize=do_stabilize))
+    # Evaluate all `(a, b)` pairs in a single computation, with `a` and `b`
+    # traced and vectorized over.
+    abs_ = [(0, 1), (0, -1), (-1, 0), (1, 0)]
+
+    @jit
+    @vmap
+    def apply_and_kernel_fn_ab_relu(ab):
+      _, apply_ab_relu, kernel_fn_ab_relu = stax.serial(
+          fc, stax.ABRelu(ab[0], ab[1], do_stabilize=do_stabilize))
+      return apply_ab_relu(params, X0_1), kernel_fn_ab_relu(X0_1, X0_2)
 
+    X1_1_ab_relus, kernels_ab_relus = apply_and_kernel_fn_ab_relu(
+        np.array(abs_, np.float32))
+    kernels_relu = kernel_fn_relu(X0_1, X0_2)
+
+    for i, (a, b) in enumerate(abs_):
+      with self.subTest(a=a, b=b):
         X1_1_relu = (b - a) * apply_relu(params, X0_1 * (-1 if a != 0 else 1))
-        X1_1_ab_relu = apply_ab_relu(params, X0_1)
-        self.assertAllClose(X1_1_relu, X1_1_ab_relu)
+        self.assertAllClose(X1_1_relu, X1_1_ab_relus[i])
 
-        kernels_relu = kernel_fn_relu(X0_1, X0_2)
-        kernels_ab_relu = kernel_fn_ab_relu(X0_1, X0_2)
+        kernels_ab_relu = tree_map(lambda x: x[i], kernels_ab_relus)
         self.assertAllClose(kernels_relu, kernels_ab_relu)
 
   def test_ab_relu_id(self, same_inputs, do_stabilize):
-    key = random.PRNGKey(1)
-    X0_1 = random.normal(key, (5, 7))
-    fc = stax.Dense(10, 1, 0)
+    X0_1 = _normal(1, (5, 7))
+    fc = _AB_RELU_FC
 
-    X0_2 = None if same_inputs else random.normal(key, (9, 7))
+    X0_2 = None if same_inputs else _normal(1, (9, 7))
 
     # Test that ABRelu(a, a) == a * Identity
-    init_fn, apply_id, kernel_fn_id = stax.serial(fc, stax.Identity())
-    _, params = init_fn(key, input_shape=(-1, 7))
+    _, apply_id, kernel_fn_id = stax.serial(fc, stax.Identity())
+    params = _get_ab_relu_params()
 
     for a in [-5, -1, -0.5, 0, 0.5, 1, 5]:
       with self.subTest(a=a):
@@ -1106,20 +1390,20 @@ class ABReluTest(test_utils.NeuralTangentsTestCase):
         self.assertAllClose(kernels_id, kernels_ab_relu)
 
   def test_leaky_relu(self, same_inputs, do_stabilize):
-    key = random.PRNGKey(1)
-    X0_1 = random.normal(key, (5, 7))
-    fc = stax.Dense(10, 1, 0)
+    X0_1 = _normal(1, (5, 7))
+    fc = _AB_RELU_FC
 
-    X0_2 = None if same_inputs else random.normal(key, (9, 7))
+    X0_2 = None if same_inputs else _normal(1, (9, 7))
+
+    params = _get_ab_relu_params()
 
     # Test that ABRelu(alpha, 1) == LeakyRelu(alpha)
     for a in [-2, -1, 0, 1, 2]:
       with self.subTest(alpha=a):
-        init_fn, apply_leaky_relu, kernel_fn_leaky_relu = stax.serial(
+        _, apply_leaky_relu, kernel_fn_leaky_relu = stax.serial(
             fc, stax.LeakyRelu(a, do_stabilize=do_stabilize))
         _, apply_ab_relu, kernel_fn_ab_relu = stax.serial(fc, stax.ABRelu(a, 1))
 
-        _, params = init_fn(key, input_shape=(-1, 7))
         X1_1_leaky_relu = apply_leaky_relu(params, X0_1)
         X1_1_ab_relu = apply_ab_relu(params, X0_1)
         self.assertAllClose(X1_1_leaky_relu, X1_1_ab_relu)
@@ -1129,18 +1413,17 @@ class ABReluTest(test_utils.NeuralTangentsTestCase):
         self.assertAllClose(kernels_leaky_relu, kernels_ab_relu)
 
   def test_abs(self, same_inputs, do_stabilize):
-    key = random.PRNGKey(1)
-    X0_1 = random.normal(key, (5, 7))
-    fc = stax.Dense(10, 1, 0)
+    X0_1 = _normal(1, (5, 7))
+    fc = _AB_RELU_FC
 
-    X0_2 = None if same_inputs else random.normal(key, (9, 7))
+    X0_2 = None if same_inputs else _normal(1, (9, 7))
 
     # Test that Abs == ABRelu(-1, 1)
-    init_fn, apply_leaky_relu, kernel_fn_abs = stax.serial(
+    _, apply_leaky_relu, kernel_fn_abs = stax.serial(
         fc, stax.Abs(do_stabilize=do_stabilize))
     _, apply_ab_relu, kernel_fn_ab_relu = stax.serial(fc, stax.ABRelu(-1, 1))
 
-    _, params = init_fn(key, input_shape=(-1, 7))
+    params = _get_ab_relu_params()
     X1_1_abs = apply_leaky_relu(params, X0_1)
     X1_1_ab_relu = apply_ab_relu(params, X0_1)
     self.assertAllClose(X1_1_abs, X1_1_ab_relu)
@@ -1150,6 +1433,11 @@ class ABReluTest(test_utils.NeuralTangentsTestCase):
     self.assertAllClose(kernels_abs, kernels_ab_relu)
 
 
+_FLATTEN = stax.Flatten()
+
+_FLATTEN_DENSE = stax.Dense(1024, 2., 0.5)
+
+
 @jtu.parameterized.parameters([
     {
         'same_inputs': True
@@ -1161,77 +1449,71 @@ class ABReluTest(test_utils.NeuralTangentsTestCase):
 class FlattenTest(test_utils.NeuralTangentsTestCase):
 
   def test_flatten(self, same_inputs):
-    key = random.PRNGKey(1)
+    key = _KEY
     X0_1 = random.normal(key, (8, 4, 3, 2))
     X0_2 = None if same_inputs else random.normal(key, (4, 4, 3, 2))
 
     X0_1_flat = np.reshape(X0_1, (X0_1.shape[0], -1))
     X0_2_flat = None if same_inputs else np.reshape(X0_2, (X0_2.shape[0], -1))
 
-    init_fc, apply_fc, kernel_fc = stax.serial(stax.Dense(1024, 2., 0.5),
-                                               stax.Relu(),
-                                               stax.Dense(1024, 2., 0.5))
-    init_top, apply_top, kernel_top = stax.serial(stax.Dense(1024, 2., 0.5),
-                                                  stax.Relu(),
-                                                  stax.Dense(1024, 2., 0.5),
-                                                  stax.Flatten())
-    init_mid, apply_mid, kernel_mid = stax.serial(stax.Dense(1024, 2., 0.5),
-                                                  stax.Relu(),
-                                                  stax.Flatten(),
-                                                  stax.Dense(1024, 2., 0.5))
-    init_bot, apply_bot, kernel_bot = stax.serial(stax.Flatten(),
-                                                  stax.Dense(1024, 2., 0.5),
-                                                  stax.Relu(),
-                                                  stax.Dense(1024, 2., 0.5))
-
-    kernel_fc_mc = monte_carlo.monte_carlo_kernel_fn(init_fc, apply_fc, key,
-                                                     200, implementation=2,
-                                                     vmap_axes=0)
-    kernel_bot_mc = monte_carlo.monte_carlo_kernel_fn(init_bot, apply_bot, key,
-                                                      200, implementation=2,
-                                                      vmap_axes=0)
-    kernel_mid_mc = monte_carlo.monte_carlo_kernel_fn(init_mid, apply_mid, key,
-                                                      200, implementation=2,
-                                                      vmap_axes=0)
-    kernel_top_mc = monte_carlo.monte_carlo_kernel_fn(init_top, apply_top, key,
-                                                      200, implementation=2,
-                                                      vmap_axes=0)
-
-    K = kernel_fc(X0_1_flat, X0_2_flat)
-
-    K_bot = kernel_bot(X0_1, X0_2)
-    K_bot_flat = kernel_bot(X0_1_flat, X0_2_flat)
+    dense = _FLATTEN_DENSE
+    net_fc = stax.serial(dense, _RELU, dense)
+    net_top = stax.serial(dense, _RELU, dense, _FLATTEN)
+    net_mid = stax.serial(dense, _RELU, _FLATTEN, dense)
+    net_bot = stax.serial(_FLATTEN, dense, _RELU, dense)
+    _, _, kernel_fc = net_fc
+    _, _, kernel_top = net_top
+    _, _, kernel_mid = net_mid
+    _, _, kernel_bot = net_bot
+
+    # Sample all Monte Carlo kernels at once, by running the nets in parallel,
+    # each on the inputs it is tested against.
+    init_mc, apply_mc, _ = stax.parallel(net_fc, net_bot, net_bot, net_mid,
+                                         net_mid, net_top, net_top)
+    kernel_mc = monte_carlo.monte_carlo_kernel_fn(init_mc, apply_mc, key, 200,
+                                                  implementation=2,
+                                                  vmap_axes=((0,) * 7,
+                                                             (0,) * 7,
+                                                             {}))
+
+    # Compute all analytic kernels in one computation, sharing common ops.
+    @jit
+    def get_kernels(X0_1, X0_2, X0_1_flat, X0_2_flat):
+      return (kernel_fc(X0_1_flat, X0_2_flat),
+              kernel_bot(X0_1, X0_2),
+              kernel_bot(X0_1_flat, X0_2_flat),
+              kernel_mid(X0_1, X0_2),
+              kernel_mid(X0_1_flat, X0_2_flat),
+              kernel_top(X0_1, X0_2),
+              kernel_top(X0_1_flat, X0_2_flat))
+
+    (K, K_bot, K_bot_flat, K_mid, K_mid_flat, K_top,
+     K_top_flat) = get_kernels(X0_1, X0_2, X0_1_flat, X0_2_flat)
+
     self.assertAllClose(K_bot, K)
     self.assertAllClose(K_bot_flat, K)
 
     def assert_close(a, b):
       self.assertAllClose(a, b, atol=0.05, rtol=0.02)
 
-    K_fc_mc = kernel_fc_mc(X0_1_flat, X0_2_flat, get='nngp')
-    K_bot_mc = kernel_bot_mc(X0_1, X0_2, get='nngp')
-    K_bot_flat_mc = kernel_bot_mc(X0_1_flat, X0_2_flat, get='nngp')
+    (K_fc_mc, K_bot_mc, K_bot_flat_mc, K_mid_mc, K_mid_flat_mc, K_top_mc,
+     K_top_flat_mc) = kernel_mc(
+         (X0_1_flat, X0_1, X0_1_flat, X0_1, X0_1_flat, X0_1, X0_1_flat),
+         (X0_2_flat, X0_2, X0_2_flat, X0_2, X0_2_flat, X0_2, X0_2_flat),
+         get='nngp')
 
     assert_close(K_fc_mc, K.nngp)
     assert_close(K_bot_mc, K_bot.nngp)
     assert_close(K_bot_flat_mc, K_bot_flat.nngp)
 
-    K_mid = kernel_mid(X0_1, X0_2)
-    K_mid_flat = kernel_mid(X0_1_flat, X0_2_flat)
-
-    K_mid_mc = kernel_mid_mc(X0_1, X0_2, get='nngp')
-    K_mid_flat_mc = kernel_mid_mc(X0_1_flat, X0_2_flat, get='nngp')
-
     assert_close(K_mid_mc, K_mid.nngp)
     assert_close(K_mid_flat, K)
     assert_close(K_mid_flat_mc, K_mid_flat.nngp)
 
-    K_top = kernel_top(X0_1, X0_2).replace(is_gaussian=True,
-                                           shape1=K_mid.shape1,
-                                           shape2=K_mid.shape2)
-    K_top_flat = kernel_top(X0_1_flat, X0_2_flat).replace(is_gaussian=True)
-
-    K_top_mc = kernel_top_mc(X0_1, X0_2, get='nngp')
-    K_top_flat_mc = kernel_top_mc(X0_1_flat, X0_2_flat, get='nngp')
+    K_top = K_top.replace(is_gaussian=True,
+                          shape1=K_mid.shape1,
+                          shape2=K_mid.shape2)
+    K_top_flat = K_top_flat.replace(is_gaussian=True)
 
     assert_close(K_top_flat, K)
     assert_close(K_top_mc, K_top.nngp)
@@ -1242,13 +1524,103 @@ class FlattenTest(test_utils.NeuralTangentsTestCase):
 
 class FanInTest(test_utils.NeuralTangentsTestCase):
 
+  _phis = (stax.Relu(), stax.Erf(), stax.Abs())
+
   @classmethod
   def _get_phi(cls, i):
-    return {
-        0: stax.Relu(),
-        1: stax.Erf(),
-        2: stax.Abs()
-    }[i % 3]
+    return cls._phis[i % 3]
+
+  @classmethod
+  def _get_fan_in_layer(cls, fan_in_mode, axis):
+    if fan_in_mode == 'FanInSum':
+      return stax.FanInSum()
+    elif fan_in_mode == 'FanInProd':
+      return stax.FanInProd()
+    return stax.FanInConcat(axis)
+
+  @classmethod
+  def _get_fc_net(cls, n_branches, axis, branch_in, fan_in_mode, get, width):
+    """Returns the network of `test_fan_in_fc`."""
+    dense = stax.Dense(width, 1.25, 0.1)
+    input_layers = [dense,
+                    stax.FanOut(n_branches)]
+
+    branches = []
+    for b in range(n_branches):
+      branch_layers = [cls._get_phi(b)]
+      for i in range(b):
+        multiplier = 1 if axis not in (1, -1) else (1 + 0.25 * i)
+        branch_layers += [
+            stax.Dense(int(width * multiplier), 1. + 2 * i, 0.5 + i),
+            cls._get_phi(i)]
+
+      if branch_in == 'dense_before_branch_in':
+        branch_layers += [dense]
+      branches += [stax.serial(*branch_layers)]
+
+    output_layers = [
+        cls._get_fan_in_layer(fan_in_mode, axis),
+        stax.Relu()
+    ]
+    if branch_in == 'dense_after_branch_in':
+      output_layers.insert(1, dense)
+
+    nn = stax.serial(*(input_layers + [stax.parallel(*branches)] +
+                       output_layers))
+
+    if get == 'nngp':
+      return nn
+    elif get == 'ntk':
+      return stax.serial(nn, stax.Dense(1, 1.25, 0.5))
+    raise ValueError(get)
+
+  @classmethod
+  def _get_conv_net(cls, n_branches, axis, branch_in, readout, fan_in_mode,
+                    get, width):
+    """Returns the network of `test_fan_in_conv`."""
+    conv = stax.Conv(out_chan=width,
+                     filter_shape=(3, 3),
+                     padding='SAME',
+                     W_std=1.25,
+                     b_std=0.1)
+
+    input_layers = [conv,
+                    stax.FanOut(n_branches)]
+
+    # Branch `b` applies the first `b` of these `(conv, phi)` blocks. Build each
+    # block once and share it between branches.
+    blocks = [
+        (stax.Conv(
+            out_chan=int(width * (1 if axis not in (3, -1) else 1 + 0.25 * i)),
+            filter_shape=(i + 1, 4 - i),
+            padding='SAME',
+            W_std=1.25 + i,
+            b_std=0.1 + i),
+         cls._get_phi(i))
+        for i in range(n_branches - 1)
+    ]
+
+    branches = []
+    for b in range(n_branches):
+      branch_layers = [cls._get_phi(b)]
+      branch_layers += [layer for block in blocks[:b] for layer in block]
+
+      if branch_in == 'dense_before_branch_in':
+        branch_layers += [conv]
+      branches += [stax.serial(*branch_layers)]
+
+    output_layers = [
+        cls._get_fan_in_layer(fan_in_mode, axis),
+        stax.Relu(),
+        stax.GlobalAvgPool() if readout == 'pool' else stax.Flatten()
+    ]
+    if branch_in == 'dense_after_branch_in':
+      output_layers.insert(1, conv)
+
+    nn = stax.serial(*(input_layers + [stax.parallel(*branches)] +
+                       output_layers))
+
+    return stax.serial(nn, stax.Dense(1 if get == 'ntk' else width, 1.25, 0.5))
 
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list(
@@ -1297,63 +1669,26 @@ class FanInTest(test_utils.NeuralTangentsTestCase):
       raise absltest.SkipTest(
           '`FanInConcat` or `FanInProd` on feature axis requires a dense layer '
           'after concatenation or Hadamard product.')
-    if fan_in_mode == 'FanInSum':
-      fan_in_layer = stax.FanInSum()
-    elif fan_in_mode == 'FanInProd':
-      fan_in_layer = stax.FanInProd()
-    else:
-      fan_in_layer = stax.FanInConcat(axis)
-
-    if xla_bridge.get_backend().platform == 'cpu':
+    if _PLATFORM == 'cpu':
       if n_branches != 2:
         raise absltest.SkipTest(
             'Skipping FanInFC test if n_branches != 2 on CPU.')
 
-    key = random.PRNGKey(1)
+    key = _KEY
     X0_1 = np.cos(random.normal(key, (4, 3)))
     X0_2 = None if same_inputs else random.normal(key, (8, 3))
 
     width = 1024
     n_samples = 256 * 2
 
-    if xla_bridge.get_backend().platform == 'tpu':
+    if _PLATFORM == 'tpu':
       tol = 0.07
     else:
       tol = 0.02
 
-    dense = stax.Dense(width, 1.25, 0.1)
-    input_layers = [dense,
-                    stax.FanOut(n_branches)]
-
-    branches = []
-    for b in range(n_branches):
-      branch_layers = [FanInTest._get_phi(b)]
-      for i in range(b):
-        multiplier = 1 if axis not in (1, -1) else (1 + 0.25 * i)
-        branch_layers += [
-            stax.Dense(int(width * multiplier), 1. + 2 * i, 0.5 + i),
-            FanInTest._get_phi(i)]
-
-      if branch_in == 'dense_before_branch_in':
-        branch_layers += [dense]
-      branches += [stax.serial(*branch_layers)]
-
-    output_layers = [
-        fan_in_layer,
-        stax.Relu()
-    ]
-    if branch_in == 'dense_after_branch_in':
-      output_layers.insert(1, dense)
-
-    nn = stax.serial(*(input_layers + [stax.parallel(*branches)] +
-                       output_layers))
-
-    if get == 'nngp':
-      init_fn, apply_fn, kernel_fn = nn
-    elif get == 'ntk':
-      init_fn, apply_fn, kernel_fn = stax.serial(nn, stax.Dense(1, 1.25, 0.5))
-    else:
-      raise ValueError(get)
+    init_fn, apply_fn, kernel_fn = self._get_fc_net(n_branches, axis,
+                                                    branch_in, fan_in_mode,
+                                                    get, width)
 
     kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
         init_fn, apply_fn, key, n_samples,
@@ -1407,7 +1742,7 @@ class FanInTest(test_utils.NeuralTangentsTestCase):
                        branch_in,
                        readout,
                        fan_in_mode):
-    if xla_bridge.get_backend().platform == 'cpu':
+    if _PLATFORM == 'cpu':
       raise absltest.SkipTest('Not running CNNs on CPU to save time.')
     if fan_in_mode in ['FanInSum', 'FanInProd']:
       if axis != 0:
@@ -1425,18 +1760,11 @@ class FanInTest(test_utils.NeuralTangentsTestCase):
                               'requires a dense layer after concatenation '
                               'or Hadamard product.')
 
-    if fan_in_mode == 'FanInSum':
-      fan_in_layer = stax.FanInSum()
-    elif fan_in_mode == 'FanInProd':
-      fan_in_layer = stax.FanInProd()
-    else:
-      fan_in_layer = stax.FanInConcat(axis)
-
-    key = random.PRNGKey(1)
+    key = _KEY
     X0_1 = random.normal(key, (2, 5, 6, 3))
     X0_2 = None if same_inputs else random.normal(key, (3, 5, 6, 3))
 
-    if xla_bridge.get_backend().platform == 'tpu':
+    if _PLATFORM == 'tpu':
       width = 2048
       n_samples = 1024
       tol = 0.02
@@ -1445,46 +1773,9 @@ class FanInTest(test_utils.NeuralTangentsTestCase):
       n_samples = 512
       tol = 0.01
 
-    conv = stax.Conv(out_chan=width,
-                     filter_shape=(3, 3),
-                     padding='SAME',
-                     W_std=1.25,
-                     b_std=0.1)
-
-    input_layers = [conv,
-                    stax.FanOut(n_branches)]
-
-    branches = []
-    for b in range(n_branches):
-      branch_layers = [FanInTest._get_phi(b)]
-      for i in range(b):
-        multiplier = 1 if axis not in (3, -1) else (1 + 0.25 * i)
-        branch_layers += [
-            stax.Conv(
-                out_chan=int(width * multiplier),
-                filter_shape=(i + 1, 4 - i),
-                padding='SAME',
-                W_std=1.25 + i,
-                b_std=0.1 + i),
-            FanInTest._get_phi(i)]
-
-      if branch_in == 'dense_before_branch_in':
-        branch_layers += [conv]
-      branches += [stax.serial(*branch_layers)]
-
-    output_layers = [
-        fan_in_layer,
-        stax.Relu(),
-        stax.GlobalAvgPool() if readout == 'pool' else stax.Flatten()
-    ]
-    if branch_in == 'dense_after_branch_in':
-      output_layers.insert(1, conv)
-
-    nn = stax.serial(*(input_layers + [stax.parallel(*branches)] +
-                       output_layers))
-
-    init_fn, apply_fn, kernel_fn = stax.serial(
-        nn, stax.Dense(1 if get == 'ntk' else width, 1.25, 0.5))
+    init_fn, apply_fn, kernel_fn = self._get_conv_net(n_branches, axis,
+                                                      branch_in, readout,
+                                                      fan_in_mode, get, width)
 
     kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
         init_fn,
@@ -1503,60 +1794,11 @@ class FanInTest(test_utils.NeuralTangentsTestCase):
 
 class ConvNDTest(test_utils.NeuralTangentsTestCase):
 
-  @jtu.parameterized.named_parameters(
-      jtu.cases_from_list({
-          'testcase_name':
-              ' [{}_n={}_{}_{}_{}_{}_{}_{}]'.format(
-                  'same_inputs' if same_inputs else 'different_inputs', n, get,
-                  proj,
-                  'attn' if use_attn else '',
-                  'channels_first' if channels_first else 'channels_last',
-                  'dropout' if use_dropout else '',
-                  'layernorm' if use_layernorm else ''
-              ),
-          'same_inputs':
-              same_inputs,
-          'n':
-              n,
-          'get':
-              get,
-          'proj':
-              proj,
-          'use_attn':
-              use_attn,
-          'channels_first':
-              channels_first,
-          'use_dropout':
-              use_dropout,
-          'use_layernorm':
-              use_layernorm
-      }
-                          for same_inputs in [False]
-                          for n in [0, 1, 2, 3]
-                          for get in ['ntk']
-                          for proj in ['flatten', 'pool']
-                          for use_attn in [True]
-                          for channels_first in [True, False]
-                          for use_dropout in [True]
-                          for use_layernorm in [True]))
-  def test_conv_nd(self, same_inputs, n, get, proj, use_attn, channels_first,
-                   use_dropout, use_layernorm):
-    platform = xla_bridge.get_backend().platform
-    if platform == 'cpu':
-      raise absltest.SkipTest('Skipping CPU CNN tests for speed.')
-    elif platform == 'gpu' and n not in (0, 1, 2, 3):
-      raise absltest.SkipTest('>=4D CNN does not work on GPU.')
-    elif platform == 'tpu' and use_dropout and same_inputs:
-      raise absltest.SkipTest('Batched empirical kernel with dropout not '
-                              'supported.')
-
-    width = 1024
-    n_samples = 512
-    tol = 0.03 if platform == 'tpu' else 0.015
-    key = random.PRNGKey(1)
-
+  @classmethod
+  def _get_net(cls, n, get, proj, use_attn, channels_first, use_dropout,
+               use_layernorm, width):
+    """Returns the network of `test_conv_nd`, with `kernel_fn` jitted."""
     n_max = 5
-    spatial_shape = (2, 3, 5, 4, 3)[:n] + (1,) * (n - n_max)
     filter_shape = (1, 2, 3, 1, 1)[:n] + (1,) * (n - n_max)
     strides = (1, 1, 2, 1, 2)[:n] + (1,) * (n - n_max)
     spatial_spec = ''.join(c for c in string.ascii_uppercase
@@ -1567,15 +1809,10 @@ class ConvNDTest(test_utils.NeuralTangentsTestCase):
       channel_axis = 1
       dimension_numbers = ('NC' + spatial_spec, filter_spec,
                            'NC' + spatial_spec)
-      X0_1 = random.normal(key, (2, 3) + spatial_shape)
-      X0_2 = None if same_inputs else random.normal(key, (4, 3) + spatial_shape)
     else:
       channel_axis = -1
       dimension_numbers = ('N' + spatial_spec + 'C', filter_spec,
                            'N' + spatial_spec + 'C')
-      X0_1 = random.normal(key, (2,) + spatial_shape + (3,))
-      X0_2 = None if same_inputs else random.normal(key,
-                                                    (4,) + spatial_shape + (3,))
 
     layernorm_axes = (dimension_numbers[2].index('C'),)
     if 'H' in dimension_numbers[2]:
@@ -1589,8 +1826,7 @@ class ConvNDTest(test_utils.NeuralTangentsTestCase):
       raise ValueError(proj)
 
     if use_attn:
-      n_heads = int(np.sqrt(width))
-      n_chan_val = int(np.round(float(width) / n_heads))
+      n_heads, n_chan_val = _attn_dims(width)
       proj = stax.serial(stax.GlobalSelfAttention(
           n_chan_out=width,
           n_chan_key=width,
@@ -1604,7 +1840,14 @@ class ConvNDTest(test_utils.NeuralTangentsTestCase):
           b_std=0.1,
           channel_axis=channel_axis), proj)
 
-    nn = stax.serial(
+    if get == 'nngp':
+      readout = stax.Dense(width, 2., 0.5)
+    elif get == 'ntk':
+      readout = stax.Dense(1, 2., 0.5)
+    else:
+      raise ValueError(get)
+
+    layers = [
         stax.Conv(width, filter_shape, None, 'SAME',
                   dimension_numbers=dimension_numbers),
         (stax.LayerNorm(layernorm_axes,
@@ -1615,20 +1858,79 @@ class ConvNDTest(test_utils.NeuralTangentsTestCase):
         stax.Conv(width, filter_shape, strides, 'CIRCULAR',
                   dimension_numbers=dimension_numbers),
         stax.Abs(),
-        proj
-    )
+        proj,
+        readout
+    ]
+    init_fn, apply_fn, kernel_fn = stax.serial(*layers)
+    return init_fn, apply_fn, jit(kernel_fn, static_argnums=(2,))
 
-    if get == 'nngp':
-      init_fn, apply_fn, kernel_fn = stax.serial(nn, stax.Dense(width, 2., 0.5))
-    elif get == 'ntk':
-      init_fn, apply_fn, kernel_fn = stax.serial(nn, stax.Dense(1, 2., 0.5))
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name':
+              ' [{}_n={}_{}_{}_{}_{}_{}_{}]'.format(
+                  'same_inputs' if same_inputs else 'different_inputs', n, get,
+                  proj,
+                  'attn' if use_attn else '',
+                  'channels_first' if channels_first else 'channels_last',
+                  'dropout' if use_dropout else '',
+                  'layernorm' if use_layernorm else ''
+              ),
+          'same_inputs':
+              same_inputs,
+          'n':
+              n,
+          'get':
+              get,
+          'proj':
+              proj,
+          'use_attn':
+              use_attn,
+          'channels_first':
+              channels_first,
+          'use_dropout':
+              use_dropout,
+          'use_layernorm':
+              use_layernorm
+      }
+                          for same_inputs in [False]
+                          for n in [0, 1, 2, 3]
+                          for get in ['ntk']
+                          for proj in ['flatten', 'pool']
+                          for use_attn in [True]
+                          for channels_first in [True, False]
+                          for use_dropout in [True]
+                          for use_layernorm in [True]))
+  def test_conv_nd(self, same_inputs, n, get, proj, use_attn, channels_first,
+                   use_dropout, use_layernorm):
+    if _PLATFORM == 'cpu':
+      raise absltest.SkipTest('Skipping CPU CNN tests for speed.')
+    elif _PLATFORM == 'gpu' and n not in (0, 1, 2, 3):
+      raise absltest.SkipTest('>=4D CNN does not work on GPU.')
+    elif _PLATFORM == 'tpu' and use_dropout and same_inputs:
+      raise absltest.SkipTest('Batched empirical kernel with dropout not '
+                              'supported.')
+
+    width = 1024
+    n_samples = 512
+    tol = 0.03 if _PLATFORM == 'tpu' else 0.015
+
+    n_max = 5
+    spatial_shape = (2, 3, 5, 4, 3)[:n] + (1,) * (n - n_max)
+    if channels_first:
+      X0_1 = _normal(1, (2, 3) + spatial_shape)
+      X0_2 = None if same_inputs else _normal(1, (4, 3) + spatial_shape)
     else:
-      raise ValueError(get)
+      X0_1 = _normal(1, (2,) + spatial_shape + (3,))
+      X0_2 = None if same_inputs else _normal(1, (4,) + spatial_shape + (3,))
 
+    init_fn, apply_fn, kernel_fn = self._get_net(n, get, proj, use_attn,
+                                                 channels_first, use_dropout,
+                                                 use_layernorm, width)
     kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, key, n_samples, implementation=2, vmap_axes=0)
+        init_fn, apply_fn, _KEY, n_samples, implementation=2,
+        vmap_axes=0)
 
-    exact = kernel_fn(X0_1, X0_2, get=get)
+    exact = kernel_fn(X0_1, X0_2, get)
     empirical = kernel_fn_mc(X0_1, X0_2, get=get)
     test_utils.assert_close_matrices(self, empirical, exact, tol)
 
@@ -1658,10 +1960,10 @@ class ConvNDTest(test_utils.NeuralTangentsTestCase):
                        stax.Identity()]))
 class DiagonalTest(test_utils.NeuralTangentsTestCase):
 
-  def _get_kernel_fn(self, same_inputs, readin, readout):
-    key = random.PRNGKey(1)
-    x1 = random.normal(key, (2, 5, 6, 3))
-    x2 = None if same_inputs else random.normal(key, (3, 5, 6, 3))
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def _get_net_kernel_fn(cls, readin, readout):
+    """Returns the `kernel_fn`, shared by all tests with the same layers."""
     layers = [readin]
     filter_shape = (2, 3) if readin[0].__name__ == 'Identity' else ()
     layers += [stax.Conv(1, filter_shape, padding='SAME'),
@@ -1670,12 +1972,22 @@ class DiagonalTest(test_utils.NeuralTangentsTestCase):
                stax.Erf(),
                readout]
     _, _, kernel_fn = stax.serial(*layers)
-    return kernel_fn, x1, x2
+    return kernel_fn
+
+  def _get_kernel_fn(self, same_inputs, readin, readout):
+    x1 = _normal(1, (2, 5, 6, 3))
+    x2 = None if same_inputs else _normal(1, (3, 5, 6, 3))
+    return self._get_net_kernel_fn(readin, readout), x1, x2
 
   def test_diagonal_batch(self, same_inputs, readin, readout):
     kernel_fn, x1, x2 = self._get_kernel_fn(same_inputs, readin, readout)
-    K = kernel_fn(x1, x2)
-    K_full = kernel_fn(x1, x2, diagonal_batch=False)
+
+    # Compute both kernels in one computation, sharing common ops.
+    @jit
+    def get_kernels(x1, x2):
+      return kernel_fn(x1, x2), kernel_fn(x1, x2, diagonal_batch=False)
+
+    K, K_full = get_kernels(x1, x2)
 
     if same_inputs:
       self.assertAllClose(K_full.cov1, K.nngp)
@@ -1690,8 +2002,12 @@ class DiagonalTest(test_utils.NeuralTangentsTestCase):
 
   def test_diagonal_spatial(self, same_inputs, readin, readout):
     kernel_fn, x1, x2 = self._get_kernel_fn(same_inputs, readin, readout)
-    K = kernel_fn(x1, x2)
-    K_full = kernel_fn(x1, x2, diagonal_spatial=False)
+
+    @jit
+    def get_kernels(x1, x2):
+      return kernel_fn(x1, x2), kernel_fn(x1, x2, diagonal_spatial=False)
+
+    K, K_full = get_kernels(x1, x2)
     batch_shape = x1.shape[0], (x1 if x2 is None else x2).shape[0]
     names = readout[0].__name__, readin[0].__name__
 
@@ -1712,27 +2028,40 @@ class DiagonalTest(test_utils.NeuralTangentsTestCase):
       else:
         self.assertEqual(K_diag.nngp.shape, batch_shape + x1.shape[1:-1])
         self.assertAllClose(K_full, K)
-        self.assertAllClose(K_diag.nngp, np.einsum('...iijj->...ij', K.nngp))
+        # Equivalent to `np.einsum('...iijj->...ij', K.nngp)`.
+        K_nngp_diag = np.diagonal(np.diagonal(K.nngp, axis1=-4, axis2=-3),
+                                  axis1=-3, axis2=-2)
+        self.assertAllClose(K_diag.nngp, K_nngp_diag)
+
+
+_ALL_DIAGONALS = tuple(itertools.product(stax._Bool, repeat=2))
+
+
+# `>>` and `<<` tables over all `(input, output)` pairs of `stax._Diagonal`.
+_COMPOSE_RIGHT = {
+    (a, b): dataclasses.astuple(stax._Diagonal(*a) >> stax._Diagonal(*b))
+    for a, b in itertools.product(_ALL_DIAGONALS, repeat=2)
+}
+_COMPOSE_LEFT = {
+    (a, b): dataclasses.astuple(stax._Diagonal(*a) << stax._Diagonal(*b))
+    for a, b in itertools.product(_ALL_DIAGONALS, repeat=2)
+}
 
 
 class DiagonalClassTest(test_utils.NeuralTangentsTestCase):
 
   def test_diagonal_compose_is_associative(self):
-    for inp_a, inp_b, inp_c in itertools.product(stax._Bool, repeat=3):
-      for out_a, out_b, out_c in itertools.product(stax._Bool, repeat=3):
-        a = stax._Diagonal(inp_a, out_a)
-        b = stax._Diagonal(inp_b, out_b)
-        c = stax._Diagonal(inp_c, out_c)
-        with self.subTest(a=a, b=b, c=c):
-          ab_c = (a >> b) >> c
-          a_bc = a >> (b >> c)
-          self.assertEqual(ab_c, a_bc)
+    for a, b, c in itertools.product(_ALL_DIAGONALS, repeat=3):
+      with self.subTest(a=a, b=b, c=c):
+        ab_c = _COMPOSE_RIGHT[_COMPOSE_RIGHT[a, b], c]
+        a_bc = _COMPOSE_RIGHT[a, _COMPOSE_RIGHT[b, c]]
+        self.assertEqual(ab_c, a_bc)
 
-          _ab_c = c << (b << a)
-          _a_bc = (c << b) << a
-          self.assertEqual(_ab_c, _a_bc)
+        _ab_c = _COMPOSE_LEFT[c, _COMPOSE_LEFT[b, a]]
+        _a_bc = _COMPOSE_LEFT[_COMPOSE_LEFT[c, b], a]
+        self.assertEqual(_ab_c, _a_bc)
 
-          self.assertEqual(ab_c, _ab_c)
+        self.assertEqual(ab_c, _ab_c)
 
 
 @jtu.parameterized.parameters([
@@ -1746,11 +2075,10 @@ class DiagonalClassTest(test_utils.NeuralTangentsTestCase):
 class InputReqTest(test_utils.NeuralTangentsTestCase):
 
   def test_input_req(self, same_inputs):
-    platform = xla_bridge.get_backend().platform
-    if platform == 'cpu':
+    if _PLATFORM == 'cpu':
       raise absltest.SkipTest('Skipping CPU CNN tests for speed.')
 
-    key = random.PRNGKey(1)
+    key = _KEY
     x1 = random.normal(key, (2, 7, 8, 4, 3))
     x2 = None if same_inputs else random.normal(key, (4, 7, 8, 4, 3))
 
@@ -1774,10 +2102,9 @@ class InputReqTest(test_utils.NeuralTangentsTestCase):
         stax.Dense(2048)
     )
 
-    correct_conv_fn_mc = monte_carlo.monte_carlo_kernel_fn(init_fn, apply_fn,
-                                                           key, 400,
-                                                           implementation=2,
-                                                           vmap_axes=0)
+    correct_conv_fn_mc = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, _get_mc_apply_fn(apply_fn), key, 400,
+        implementation=2, vmap_axes=0)
     K = correct_conv_fn(x1, x2, get='nngp')
     K_mc = correct_conv_fn_mc(x1, x2, get='nngp')
     self.assertAllClose(K, K_mc, atol=0.01, rtol=0.05)
@@ -1802,10 +2129,9 @@ class InputReqTest(test_utils.NeuralTangentsTestCase):
         stax.Dense(1024)
     )
 
-    correct_conv_fn_mc = monte_carlo.monte_carlo_kernel_fn(init_fn, apply_fn,
-                                                           key, 300,
-                                                           implementation=2,
-                                                           vmap_axes=0)
+    correct_conv_fn_mc = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, _get_mc_apply_fn(apply_fn), key, 300,
+        implementation=2, vmap_axes=0)
     K = correct_conv_fn(x1, x2, get='nngp')
     K_mc = correct_conv_fn_mc(x1, x2, get='nngp')
     self.assertAllClose(K, K_mc, atol=0.01, rtol=0.05)
@@ -1827,63 +2153,98 @@ class InputReqTest(test_utils.NeuralTangentsTestCase):
         stax.Dense(1)
     )
 
-    correct_conv_fn_mc = monte_carlo.monte_carlo_kernel_fn(init_fn, apply_fn,
-                                                           key, 200,
-                                                           implementation=2,
-                                                           vmap_axes=0)
+    correct_conv_fn_mc = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, _get_mc_apply_fn(apply_fn), key, 200,
+        implementation=2, vmap_axes=0)
     K = correct_conv_fn(x1, x2, get='ntk')
     K_mc = correct_conv_fn_mc(x1, x2, get='ntk')
     self.assertAllClose(K, K_mc, atol=0.01, rtol=0.05)
 
 
-class MaskingTest(test_utils.NeuralTangentsTestCase):
+_MASK_FC_CASES = tuple(
+    {
+        'testcase_name':
+            ' [{}_get={}_axis={}_mask={}_concat={}_p={}]'.format(
+                'same_inputs' if same_inputs else 'different_inputs',
+                get,
+                mask_axis,
+                mask_constant,
+                concat,
+                p,
+            ),
+        'same_inputs':
+            same_inputs,
+        'get':
+            get,
+        'mask_axis':
+            mask_axis,
+        'mask_constant':
+            mask_constant,
+        'concat':
+            concat,
+        'p':
+            p,
+    }
+    for same_inputs in [False] for get in ['ntk']
+    for concat in [None, 0, 1] for p in [0.5]
+    for mask_axis in [(),
+                      (0,),
+                      (1, 3)]
+    for mask_constant in [10.])
 
-  @jtu.parameterized.named_parameters(
-      jtu.cases_from_list(
-          {
-              'testcase_name':
-                  ' [{}_get={}_axis={}_mask={}_concat={}_p={}]'.format(
-                      'same_inputs' if same_inputs else 'different_inputs',
-                      get,
-                      mask_axis,
-                      mask_constant,
-                      concat,
-                      p,
-                  ),
-              'same_inputs':
-                  same_inputs,
-              'get':
-                  get,
-              'mask_axis':
-                  mask_axis,
-              'mask_constant':
-                  mask_constant,
-              'concat':
-                  concat,
-              'p':
-                  p,
-          }
-          for same_inputs in [False] for get in ['ntk']
-          for concat in [None, 0, 1] for p in [0.5]
-          for mask_axis in [(),
-                            (0,),
-                            (1, 3)]
-          for mask_constant in [10.]))
-  def test_mask_fc(self, same_inputs, get, concat, p, mask_axis, mask_constant):
-    width = 512
-    n_samples = 128
-    tol = 0.04
-    key = random.PRNGKey(1)
 
-    x1 = random.normal(key, (4, 6, 5, 7))
-    x1 = _mask(x1, mask_constant, mask_axis, key, p)
+_CONCAT_BY_N = tuple((None,) + tuple(range(n + 1)) for n in range(3))
 
-    if same_inputs:
-      x2 = None
-    else:
-      x2 = random.normal(key, (2, 6, 5, 7))
-      x2 = _mask(x2, mask_constant, mask_axis, key, p)
 
+_MASK_CONV_CASES = tuple(
+    {
+        'testcase_name':
+            ' [{}_get={}_axis={}_mask={}_concat={}_{}_p={}_n={}_{}]'.format(
+                'same_inputs' if same_inputs else 'different_inputs',
+                get,
+                mask_axis,
+                mask_constant,
+                concat,
+                proj,
+                p,
+                n,
+                'transpose' if transpose else ''
+            ),
+        'same_inputs': same_inputs,
+        'get': get,
+        'mask_axis': mask_axis,
+        'mask_constant': mask_constant,
+        'concat': concat,
+        'proj': proj,
+        'p': p,
+        'n': n,
+        'transpose': transpose
+    }
+    for proj in ['flatten', 'avg']
+    for same_inputs in [False]
+    for get in ['ntk']
+    for n in [0, 1, 2]
+    for concat in _CONCAT_BY_N[n]
+    for mask_constant in [10.]
+    for p in [0.5]
+    for transpose in [True, False]
+    for mask_axis in [(),
+                      (0,),
+                      (0, 1, 2, 3)
+                      ])
+
+
+class MaskingTest(test_utils.NeuralTangentsTestCase):
+
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def _get_fc_kernel_fns(cls, concat, get, width, n_samples):
+    """Returns exact and Monte Carlo `kernel_fn`s of `test_mask_fc` nets.
+
+    Masking only changes the inputs, so cases differing only in `mask_axis`,
+    `mask_constant` or `p` share the network, its sampler and their compiled
+    code.
+    """
     nn = stax.serial(
         stax.Flatten(),
         stax.FanOut(3),
@@ -1920,68 +2281,47 @@ class MaskingTest(test_utils.NeuralTangentsTestCase):
       raise ValueError(get)
 
     kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, key, n_samples,
+        init_fn, apply_fn, _KEY, _mc_chunks(n_samples),
         device_count=0 if concat in (0, -2) else -1,
         implementation=2,
         vmap_axes=None if concat in (0, -2) else 0,
     )
 
-    kernel_fn = jit(kernel_fn, static_argnums=(2,))
-    exact = kernel_fn(x1, x2, get, mask_constant=mask_constant)
-    empirical = kernel_fn_mc(x1, x2, get=get, mask_constant=mask_constant)
-    test_utils.assert_close_matrices(self, empirical, exact, tol)
+    return jit(kernel_fn, static_argnums=(2,)), kernel_fn_mc
 
   @jtu.parameterized.named_parameters(
-      jtu.cases_from_list({
-          'testcase_name':
-          ' [{}_get={}_axis={}_mask={}_concat={}_{}_p={}_n={}_{}]'
-          ''.format(
-              'same_inputs' if same_inputs else 'different_inputs',
-              get,
-              mask_axis,
-              mask_constant,
-              concat,
-              proj,
-              p,
-              n,
-              'transpose' if transpose else ''
-          ),
-          'same_inputs': same_inputs,
-          'get': get,
-          'mask_axis': mask_axis,
-          'mask_constant': mask_constant,
-          'concat': concat,
-          'proj': proj,
-          'p': p,
-          'n': n,
-          'transpose': transpose
-      }
-                          for proj in ['flatten', 'avg']
-                          for same_inputs in [False]
-                          for get in ['ntk']
-                          for n in [0, 1, 2]
-                          for concat in [None] + list(range(n + 1))
-                          for mask_constant in [10.]
-                          for p in [0.5]
-                          for transpose in [True, False]
-                          for mask_axis in [(),
-                                            (0,),
-                                            (0, 1, 2, 3)
-                                            ]
-                          ))
-  def test_mask_conv(self, same_inputs, get, mask_axis, mask_constant, concat,
-                     proj, p, n, transpose):
-    if xla_bridge.get_backend().platform == 'cpu':
-      raise absltest.SkipTest('Skipping CNN tests on CPU for speed.')
-    elif xla_bridge.get_backend().platform == 'gpu' and n > 3:
-      raise absltest.SkipTest('>=4D-CNN is not supported on GPUs.')
+      jtu.cases_from_list(_MASK_FC_CASES))
+  def test_mask_fc(self, same_inputs, get, concat, p, mask_axis, mask_constant):
+    width = 512
+    n_samples = 128
+    tol = 0.04
+    key = _KEY
 
-    width = 256
-    n_samples = 256
-    tol = 0.03
-    key = random.PRNGKey(1)
+    x1 = random.normal(key, (4, 6, 5, 7))
+    x1 = _mask(x1, mask_constant, mask_axis, key, p)
 
-    spatial_shape = ((1, 2, 3, 2, 1) if transpose else (15, 8, 9))[:n]
+    if same_inputs:
+      x2 = None
+    else:
+      x2 = random.normal(key, (2, 6, 5, 7))
+      x2 = _mask(x2, mask_constant, mask_axis, key, p)
+
+    kernel_fn, kernel_fn_mc = self._get_fc_kernel_fns(concat, get, width,
+                                                      n_samples)
+    exact = kernel_fn(x1, x2, get, mask_constant=mask_constant)
+    empirical = _get_converged_mc_kernel(kernel_fn_mc, n_samples, x1, x2, get,
+                                         tol, mask_constant=mask_constant)
+    test_utils.assert_close_matrices(self, empirical, exact, tol)
+
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def _get_conv_kernel_fns(cls, n, transpose, proj, concat, get, width,
+                           n_samples):
+    """Returns exact and Monte Carlo `kernel_fn`s of `test_mask_conv` nets.
+
+    Masking only changes the inputs, so cases differing only in `mask_axis` or
+    `mask_constant` share the network, its sampler and their compiled code.
+    """
     filter_shape = ((2, 3, 1, 2, 1) if transpose else (7, 2, 3))[:n]
     strides = (2, 1, 3, 2, 3)[:n]
     spatial_spec = 'HWDZX'[:n]
@@ -1989,21 +2329,14 @@ class MaskingTest(test_utils.NeuralTangentsTestCase):
                          'OI' + spatial_spec,
                          'N' + spatial_spec + 'C')
 
-    x1 = np.cos(random.normal(key, (2,) + spatial_shape + (2,)))
-    x1 = _mask(x1, mask_constant, mask_axis, key, p)
-
-    if same_inputs:
-      x2 = None
-    else:
-      x2 = np.cos(random.normal(key, (4,) + spatial_shape + (2,)))
-      x2 = _mask(x2, mask_constant, mask_axis, key, p)
+    n_heads, n_chan_val = _attn_dims(width)
 
     def get_attn():
       return stax.GlobalSelfAttention(
           n_chan_out=width,
           n_chan_key=width,
-          n_chan_val=int(np.round(float(width) / int(np.sqrt(width)))),
-          n_heads=int(np.sqrt(width)),
+          n_chan_val=n_chan_val,
+          n_heads=n_heads,
       ) if proj == 'avg' else stax.Identity()
 
     conv = stax.ConvTranspose if transpose else stax.Conv
@@ -2093,59 +2426,136 @@ class MaskingTest(test_utils.NeuralTangentsTestCase):
       raise ValueError(get)
 
     kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, key, n_samples,
+        init_fn, apply_fn, _KEY, _mc_chunks(n_samples),
         device_count=0 if concat in (0, -n) else -1,
         implementation=2,
         vmap_axes=None if concat in (0, -n) else 0,
     )
 
-    kernel_fn = jit(kernel_fn, static_argnums=(2,))
+    return jit(kernel_fn, static_argnums=(2,)), kernel_fn_mc
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list(_MASK_CONV_CASES))
+  def test_mask_conv(self, same_inputs, get, mask_axis, mask_constant, concat,
+                     proj, p, n, transpose):
+    if _PLATFORM == 'cpu':
+      raise absltest.SkipTest('Skipping CNN tests on CPU for speed.')
+    elif _PLATFORM == 'gpu' and n > 3:
+      raise absltest.SkipTest('>=4D-CNN is not supported on GPUs.')
+
+    width = 256
+    n_samples = 256
+    tol = 0.03
+    key = _KEY
+
+    spatial_shape = ((1, 2, 3, 2, 1) if transpose else (15, 8, 9))[:n]
+    x1 = np.cos(random.normal(key, (2,) + spatial_shape + (2,)))
+    x1 = _mask(x1, mask_constant, mask_axis, key, p)
+
+    if same_inputs:
+      x2 = None
+    else:
+      x2 = np.cos(random.normal(key, (4,) + spatial_shape + (2,)))
+      x2 = _mask(x2, mask_constant, mask_axis, key, p)
+
+    kernel_fn, kernel_fn_mc = self._get_conv_kernel_fns(
+        n, transpose, proj, concat, get, width, n_samples)
     exact = kernel_fn(x1, x2, get, mask_constant=mask_constant)
-    empirical = kernel_fn_mc(x1, x2, get=get, mask_constant=mask_constant)
+    empirical = _get_cached_mc_kernel(
+        self.id(),
+        (width, n_samples, tol),
+        lambda: _get_converged_mc_kernel(kernel_fn_mc, n_samples, x1, x2, get,
+                                         tol, mask_constant=mask_constant))
     test_utils.assert_close_matrices(self, empirical, exact, tol)
 
 
 class ParallelInOutTest(test_utils.NeuralTangentsTestCase):
 
-  @jtu.parameterized.named_parameters(
-      jtu.cases_from_list({
-          'testcase_name':
-              f'_same_inputs={same_inputs}_kernel_type={kernel_type}',
-          'same_inputs': same_inputs,
-          'kernel_type': kernel_type
-      }
-                          for same_inputs in [True, False]
-                          for kernel_type in ['ntk']))
-  def test_parallel_in(self, same_inputs, kernel_type):
-    platform = xla_bridge.get_backend().platform
-    rtol = RTOL if platform != 'tpu' else 0.05
-
+  @classmethod
+  @functools.lru_cache(maxsize=4)
+  def _get_cases(cls, same_inputs, kernel_type):
+    """Returns `(x1, x2, net)` of `test_parallel_{in, out, in_out}`."""
     rng = random.PRNGKey(0)
-    input_key1, input_key2, mc_key = random.split(rng, 3)
+    input_key1, input_key2, _ = random.split(rng, 3)
+    input_key_out, _ = random.split(rng, 2)
 
     x1_1, x2_1 = _get_inputs(input_key1, same_inputs, (BATCH_SIZE, 2))
     x1_2, x2_2 = _get_inputs(input_key2, same_inputs, (BATCH_SIZE, 3))
 
-    x1 = (x1_1, x1_2)
-    x2 = (x2_1, x2_2)
-
     N = 2 ** 7
+    net_in = stax.serial(
+        stax.parallel(stax.Dense(N), stax.Dense(N)),
+        stax.serial(stax.FanInSum(),
+                    stax.Dense(N if kernel_type == 'nngp' else 1)))
+    case_in = ((x1_1, x1_2), (x2_1, x2_2), net_in)
+
+    x1, x2 = _get_inputs(input_key_out, same_inputs, (BATCH_SIZE, 1))
+
+    N = 2 ** 10
+    net_out = stax.serial(
+        stax.Dense(N),
+        stax.FanOut(2),
+        stax.parallel(stax.Dense(N if kernel_type == 'nngp' else 1),
+                      stax.Dense(N if kernel_type == 'nngp' else 1)))
+    case_out = (x1, x2, net_out)
+
+    x1_1, x2_1 = _get_inputs(input_key1, same_inputs, (BATCH_SIZE, 1))
+    x1_2, x2_2 = _get_inputs(input_key2, same_inputs, (BATCH_SIZE, 2))
+
+    N_in = 2 ** 10
+    N_out = N_in if kernel_type == 'nngp' else 1
+
+    readin = stax.serial(stax.parallel(stax.Dense(N_in), stax.Dense(N_in)),
+                         stax.FanInSum())
+    readout = stax.serial(stax.FanOut(3),
+                          stax.parallel(stax.Dense(N_out),
+                                        stax.Dense(N_out + 1),
+                                        stax.Dense(N_out + 2)))
+    case_in_out = ((x1_1, x1_2), (x2_1, x2_2), (readin, readout))
+    return case_in, case_out, case_in_out
 
-    def net(logits):
-      return stax.serial(
-          stax.parallel(stax.Dense(N), stax.Dense(N)),
-          stax.serial(stax.FanInSum(), stax.Dense(logits)))
+  @classmethod
+  @functools.lru_cache(maxsize=4)
+  def _get_empirical_kernels(cls, same_inputs, kernel_type):
+    """Samples Monte Carlo kernels of all `_get_cases` nets at once.
 
-    init_fn, apply_fn, kernel_fn = net(N if kernel_type == 'nngp' else 1)
+    The nets are run in parallel, each on its own inputs, so that a single
+    sampler is compiled instead of three.
+    """
+    _, _, mc_key = random.split(random.PRNGKey(0), 3)
+    case_in, case_out, case_in_out = cls._get_cases(same_inputs, kernel_type)
+    readin, readout = case_in_out[2]
 
+    init_fn, apply_fn, _ = stax.parallel(case_in[2],
+                                         case_out[2],
+                                         stax.serial(readin, readout))
     kernel_fn_empirical = monte_carlo.monte_carlo_kernel_fn(
         init_fn, apply_fn, mc_key, N_SAMPLES, trace_axes=(-1,),
         implementation=2,
-        vmap_axes=((0, 0), 0, {})
+        vmap_axes=(((0, 0), 0, (0, 0)), (0, [0, 0], [0, 0, 0]), {})
     )
+    x1 = (case_in[0], case_out[0], case_in_out[0])
+    x2 = None if same_inputs else (case_in[1], case_out[1], case_in_out[1])
+    return kernel_fn_empirical(x1, x2, kernel_type)
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name':
+              f'_same_inputs={same_inputs}_kernel_type={kernel_type}',
+          'same_inputs': same_inputs,
+          'kernel_type': kernel_type
+      }
+                          for same_inputs in [True, False]
+                          for kernel_type in ['ntk']))
+  def test_parallel_in(self, same_inputs, kernel_type):
+    rtol = RTOL if _PLATFORM != 'tpu' else 0.05
+
+    (x1, x2, (_, _, kernel_fn)), _, _ = self._get_cases(same_inputs,
+                                                        kernel_type)
+    K_empirical, _, _ = self._get_empirical_kernels(same_inputs, kernel_type)
     test_utils.assert_close_matrices(self,
                                      kernel_fn(x1, x2, kernel_type),
-                                     kernel_fn_empirical(x1, x2, kernel_type),
+                                     K_empirical,
                                      rtol)
 
   @jtu.parameterized.named_parameters(
@@ -2156,32 +2566,14 @@ class ParallelInOutTest(test_utils.NeuralTangentsTestCase):
           'kernel_type': kernel_type
       } for same_inputs in [True, False] for kernel_type in ['ntk']))
   def test_parallel_out(self, same_inputs, kernel_type):
-    platform = xla_bridge.get_backend().platform
-    rtol = RTOL if platform != 'tpu' else 0.05
-
-    rng = random.PRNGKey(0)
-    input_key1, mc_key = random.split(rng, 2)
-
-    x1, x2 = _get_inputs(input_key1, same_inputs, (BATCH_SIZE, 1))
-
-    N = 2 ** 10
-
-    def net(logits):
-      return stax.serial(
-          stax.Dense(N),
-          stax.FanOut(2),
-          stax.parallel(stax.Dense(logits), stax.Dense(logits)))
-
-    init_fn, apply_fn, kernel_fn = net(N if kernel_type == 'nngp' else 1)
-
-    kernel_fn_empirical = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, mc_key, N_SAMPLES, trace_axes=(-1,),
-        implementation=2,
-        vmap_axes=(0, [0, 0], {}))
+    rtol = RTOL if _PLATFORM != 'tpu' else 0.05
 
+    _, (x1, x2, (_, _, kernel_fn)), _ = self._get_cases(same_inputs,
+                                                        kernel_type)
+    _, K_empirical, _ = self._get_empirical_kernels(same_inputs, kernel_type)
     test_utils.assert_close_matrices(self,
                                      kernel_fn(x1, x2, kernel_type),
-                                     kernel_fn_empirical(x1, x2, kernel_type),
+                                     K_empirical,
                                      rtol)
 
   @jtu.parameterized.named_parameters(
@@ -2192,49 +2584,28 @@ class ParallelInOutTest(test_utils.NeuralTangentsTestCase):
           'kernel_type': kernel_type,
       } for same_inputs in [True, False] for kernel_type in ['ntk']))
   def test_parallel_in_out(self, same_inputs, kernel_type):
-    platform = xla_bridge.get_backend().platform
-    rtol = RTOL if platform != 'tpu' else 0.05
+    rtol = RTOL if _PLATFORM != 'tpu' else 0.05
 
-    rng = random.PRNGKey(0)
-    input_key1, input_key2, mc_key = random.split(rng, 3)
+    _, _, (x1, x2, (readin, readout)) = self._get_cases(same_inputs,
+                                                        kernel_type)
+    _, _, K_empirical = self._get_empirical_kernels(same_inputs, kernel_type)
+    _, _, readin_kernel_fn = readin
+    _, _, readout_kernel_fn = readout
 
-    x1_1, x2_1 = _get_inputs(input_key1, same_inputs, (BATCH_SIZE, 1))
-    x1_2, x2_2 = _get_inputs(input_key2, same_inputs, (BATCH_SIZE, 2))
-
-    x1 = (x1_1, x1_2)
-    x2 = (x2_1, x2_2)
-
-    N_in = 2 ** 10
-    N_out = N_in if kernel_type == 'nngp' else 1
-
-    readin = stax.serial(stax.parallel(stax.Dense(N_in), stax.Dense(N_in)),
-                         stax.FanInSum())
-    readout = stax.serial(stax.FanOut(3),
-                          stax.parallel(stax.Dense(N_out),
-                                        stax.Dense(N_out + 1),
-                                        stax.Dense(N_out + 2)))
-    init_fn, apply_fn, _ = stax.serial(readin, readout)
-
-    K_readin_fn = jit(readin[2])
-    K_readout_fn = jit(functools.partial(readout[2], get=kernel_type))
-
-    kernel_fn_empirical = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, mc_key, N_SAMPLES, trace_axes=(-1,),
-        implementation=2,
-        vmap_axes=((0, 0), [0, 0, 0], {})
-    )
+    # Compose readin and readout in one computation, without materializing
+    # the intermediate `Kernel`.
+    @functools.partial(jit, static_argnums=(2,))
+    def K_fn(x1, x2, get):
+      return readout_kernel_fn(readin_kernel_fn(x1, x2), get=get)
 
     test_utils.assert_close_matrices(
         self,
-        K_readout_fn(K_readin_fn(x1, x2)),
-        kernel_fn_empirical(x1, x2, get=kernel_type),
+        K_fn(x1, x2, kernel_type),
+        K_empirical,
         rtol)
 
     # Check Both (here we just want to make sure we _can_ compute the output).
-    K_readin_fn = jit(readin[2])
-    K_readout_fn = jit(functools.partial(readout[2], get=('nngp', 'ntk')))
-
-    K_readout_fn(K_readin_fn(x1, x2))
+    K_fn(x1, x2, ('nngp', 'ntk'))
 
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
@@ -2244,8 +2615,7 @@ class ParallelInOutTest(test_utils.NeuralTangentsTestCase):
           'kernel_type': kernel_type,
       } for same_inputs in [True, False] for kernel_type in ['ntk']))
   def test_nested_parallel(self, same_inputs, kernel_type):
-    platform = xla_bridge.get_backend().platform
-    rtol = RTOL if platform != 'tpu' else 0.05
+    rtol = RTOL if _PLATFORM != 'tpu' else 0.05
 
     rng = random.PRNGKey(0)
     (input_key1,
@@ -2275,7 +2645,7 @@ class ParallelInOutTest(test_utils.NeuralTangentsTestCase):
 
     # We only include dropout on non-TPU backends, because it takes large N to
     # converge on TPU.
-    dropout_or_id = stax.Dropout(0.9) if platform != 'tpu' else stax.Identity()
+    dropout_or_id = stax.Dropout(0.9) if _PLATFORM != 'tpu' else stax.Identity()
 
     init_fn, apply_fn, kernel_fn = \
         stax.parallel(
@@ -2291,7 +2661,7 @@ class ParallelInOutTest(test_utils.NeuralTangentsTestCase):
     kernel_fn_empirical = monte_carlo.monte_carlo_kernel_fn(
         init_fn, apply_fn, mc_key, N_SAMPLES, implementation=2,
         vmap_axes=(((((0, 0), 0), 0), (((0, 0), 0), 0), {})
-                   if platform == 'tpu' else None)
+                   if _PLATFORM == 'tpu' else None)
     )
 
     test_utils.assert_close_matrices(
@@ -2301,73 +2671,129 @@ class ParallelInOutTest(test_utils.NeuralTangentsTestCase):
         rtol)
 
 
+_ATTENTION_CASES = tuple(
+    {
+        'testcase_name':
+            f'[same_inputs={same_inputs}_'
+            f'get={get}_'
+            f'axis={mask_axis}'
+            f'_mask={mask_constant}_'
+            f'p={p}_'
+            f'linear_scaling={linear_scaling}_'
+            f'n={n}_pos_emb_type={pos_emb_type}_'
+            f'n_chan_pos_emb={n_chan_pos_emb}'
+            f'_pos_emb_decay_fn={pos_emb_decay_fn}_'
+            f'val_pos_emb={val_pos_emb}_'
+            f'W_pos_emb_std={W_pos_emb_std}]',
+        'same_inputs': same_inputs,
+        'get': get,
+        'n': n,
+        'linear_scaling': linear_scaling,
+        'mask_constant': mask_constant,
+        'p': p,
+        'mask_axis': mask_axis,
+        'pos_emb_type': pos_emb_type,
+        'n_chan_pos_emb': n_chan_pos_emb,
+        'pos_emb_decay_fn': pos_emb_decay_fn,
+        'val_pos_emb': val_pos_emb,
+        'W_pos_emb_std': W_pos_emb_std
+    }
+    for same_inputs in [
+        False
+    ]
+    for get in [
+        'ntk'
+    ]
+    for n in [
+        2,
+    ]
+    for linear_scaling in [
+        True,
+        False
+    ]
+    for mask_constant in [
+        10.
+    ]
+    for p in [0.5]
+    for mask_axis in [(-1,)]
+    for pos_emb_type in [
+        'CONCAT',
+        'SUM',
+        'NONE'
+    ]
+    for n_chan_pos_emb in ([None]
+                           if pos_emb_type != 'CONCAT'
+                           else [None, 512])
+    for pos_emb_decay_fn in [
+        None,
+        'linear'
+    ]
+    for val_pos_emb in ([
+        True,
+        False
+    ] if pos_emb_type != 'NONE' else [True])
+    for W_pos_emb_std in ([
+        2,
+    ] if pos_emb_type != 'NONE' else [0.]))
+
+
 class AttentionTest(test_utils.NeuralTangentsTestCase):
 
+  _pos_emb_fns = {
+      None: None,
+      'one_hot': lambda x: x == 0,
+      'linear': lambda x: 1 / (1 + 4 * x)
+  }
+
+  @classmethod
+  def _get_kernel_fns(cls, get, n, linear_scaling, pos_emb_type,
+                      n_chan_pos_emb, pos_emb_decay_fn, val_pos_emb,
+                      W_pos_emb_std, width, n_samples):
+    """Returns exact and Monte Carlo `kernel_fn`s of `test_attention` nets."""
+    n_heads, n_chan_val = _attn_dims(width)
+
+    nn = stax.serial(
+        stax.Conv(width, (1,) * n, padding='SAME'),
+        stax.GlobalSelfAttention(
+            linear_scaling=linear_scaling,
+            n_chan_out=width,
+            n_chan_key=width,
+            n_chan_val=n_chan_val,
+            n_heads=n_heads,
+            n_chan_pos_emb=n_chan_pos_emb,
+            attention_mechanism='SOFTMAX' if linear_scaling else 'IDENTITY',
+            pos_emb_type=pos_emb_type,
+            W_pos_emb_std=W_pos_emb_std,
+            pos_emb_decay_fn=cls._pos_emb_fns[pos_emb_decay_fn],
+            val_pos_emb=val_pos_emb,
+            W_key_std=0.9,
+            W_out_std=1.2,
+            W_query_std=0.7,
+            W_value_std=1.5,
+            b_std=0.9
+        ),
+        stax.Relu(),
+        stax.GlobalAvgPool()
+    )
+
+    if get == 'nngp':
+      init_fn, apply_fn, kernel_fn = nn
+    elif get == 'ntk':
+      init_fn, apply_fn, kernel_fn = stax.serial(nn, stax.Dense(1, 1., 0.))
+    else:
+      raise ValueError(get)
+
+    kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, apply_fn, _KEY, n_samples,
+        device_count=-1,
+        implementation=2,
+        vmap_axes=0
+    )
+
+    return jit(kernel_fn, static_argnums=(2,)), kernel_fn_mc
+
   @jtu.parameterized.named_parameters(
-      jtu.cases_from_list({
-          'testcase_name':
-              f'[same_inputs={same_inputs}_'
-              f'get={get}_'
-              f'axis={mask_axis}'
-              f'_mask={mask_constant}_'
-              f'p={p}_'
-              f'linear_scaling={linear_scaling}_'
-              f'n={n}_pos_emb_type={pos_emb_type}_'
-              f'n_chan_pos_emb={n_chan_pos_emb}'
-              f'_pos_emb_decay_fn={pos_emb_decay_fn}_'
-              f'val_pos_emb={val_pos_emb}_'
-              f'W_pos_emb_std={W_pos_emb_std}]',
-          'same_inputs': same_inputs,
-          'get': get,
-          'n': n,
-          'linear_scaling': linear_scaling,
-          'mask_constant': mask_constant,
-          'p': p,
-          'mask_axis': mask_axis,
-          'pos_emb_type': pos_emb_type,
-          'n_chan_pos_emb': n_chan_pos_emb,
-          'pos_emb_decay_fn': pos_emb_decay_fn,
-          'val_pos_emb': val_pos_emb,
-          'W_pos_emb_std': W_pos_emb_std
-      }
-                          for same_inputs in [
-                              False
-                          ]
-                          for get in [
-                              'ntk'
-                          ]
-                          for n in [
-                              2,
-                          ]
-                          for linear_scaling in [
-                              True,
-                              False
-                          ]
-                          for mask_constant in [
-                              10.
-                          ]
-                          for p in [0.5]
-                          for mask_axis in [(-1,)]
-                          for pos_emb_type in [
-                              'CONCAT',
-                              'SUM',
-                              'NONE'
-                          ]
-                          for n_chan_pos_emb in ([None]
-                                                 if pos_emb_type != 'CONCAT'
-                                                 else [None, 512])
-                          for pos_emb_decay_fn in [
-                              None,
-                              'linear'
-                          ]
-                          for val_pos_emb in ([
-                              True,
-                              False
-                          ] if pos_emb_type != 'NONE' else [True])
-                          for W_pos_emb_std in ([
-                              2,
-                          ] if pos_emb_type != 'NONE' else [0.])
-                          ))
+      jtu.cases_from_list(_ATTENTION_CASES))
   def test_attention(
       self,
       same_inputs,
@@ -2382,13 +2808,13 @@ class AttentionTest(test_utils.NeuralTangentsTestCase):
       pos_emb_decay_fn,
       val_pos_emb,
       W_pos_emb_std):
-    if xla_bridge.get_backend().platform == 'cpu':
+    if _PLATFORM == 'cpu':
       raise absltest.SkipTest('Skipping attention tests on CPU for speed.')
 
     width = 1024
     n_samples = 1024
     tol = 0.05
-    key = random.PRNGKey(1)
+    key = _KEY
     n_chan_in = 2
     spatial_shape = (2, 3, 4, 3, 2, 1)[:n]
     mask_axis = [i % (n + 2) for i in mask_axis]
@@ -2401,57 +2827,15 @@ class AttentionTest(test_utils.NeuralTangentsTestCase):
     X0_1 = get_x0(2)
     X0_2 = None if same_inputs else get_x0(4)
 
-    pos_emb_fns = {
-        None: None,
-        'one_hot': lambda x: x == 0,
-        'linear': lambda x: 1 / (1 + 4 * x)
-    }
+    kernel_fn, kernel_fn_mc = self._get_kernel_fns(
+        get, n, linear_scaling, pos_emb_type, n_chan_pos_emb, pos_emb_decay_fn,
+        val_pos_emb, W_pos_emb_std, width, n_samples)
 
-    def get_attn():
-      return stax.GlobalSelfAttention(
-          linear_scaling=linear_scaling,
-          n_chan_out=width,
-          n_chan_key=width,
-          n_chan_val=int(np.round(float(width) / int(np.sqrt(width)))),
-          n_heads=int(np.sqrt(width)),
-          n_chan_pos_emb=n_chan_pos_emb,
-          attention_mechanism='SOFTMAX' if linear_scaling else 'IDENTITY',
-          pos_emb_type=pos_emb_type,
-          W_pos_emb_std=W_pos_emb_std,
-          pos_emb_decay_fn=pos_emb_fns[pos_emb_decay_fn],
-          val_pos_emb=val_pos_emb,
-          W_key_std=0.9,
-          W_out_std=1.2,
-          W_query_std=0.7,
-          W_value_std=1.5,
-          b_std=0.9
-      )
-
-    nn = stax.serial(
-        stax.Conv(width, (1,) * n, padding='SAME'),
-        get_attn(),
-        stax.Relu(),
-        stax.GlobalAvgPool()
-    )
-
-    if get == 'nngp':
-      init_fn, apply_fn, kernel_fn = nn
-    elif get == 'ntk':
-      init_fn, apply_fn, kernel_fn = stax.serial(nn, stax.Dense(1, 1., 0.))
-    else:
-      raise ValueError(get)
-
-    kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, key, n_samples,
-        device_count=-1,
-        implementation=2,
-        vmap_axes=0
-    )
-
-    kernel_fn = jit(kernel_fn, static_argnums=(2,))
     exact = kernel_fn(X0_1, X0_2, get, mask_constant=mask_constant)
-
-    empirical = kernel_fn_mc(X0_1, X0_2, get=get, mask_constant=mask_constant)
+    empirical = _get_cached_mc_kernel(
+        self.id(),
+        (width, n_samples),
+        lambda: kernel_fn_mc(X0_1, X0_2, get=get, mask_constant=mask_constant))
     test_utils.assert_close_matrices(self, empirical, exact, tol)
 
 
@@ -2483,25 +2867,24 @@ class AggregateTest(test_utils.NeuralTangentsTestCase):
     batch1, batch2 = 8, 6
     num_channels = 12
     output_dims = 1 if get == 'ntk' else 1024
-    key = random.PRNGKey(1)
-    key, split1, split2 = random.split(key, 3)
-    x1 = random.normal(split1, (batch1,) + shape + (num_channels,))
-    x2 = x1 if same_input else random.normal(
-        split2, (batch2,) + shape + (num_channels,))
+    (x1_key, x2_key, mask_key,
+     pattern1_key, pattern2_key) = random.split(_KEY, 5)
+    # `x2=None` lets both kernels exploit symmetry of `same_input` cases. Note
+    # that `Aggregate` still needs `pattern2` (equal to `pattern1`) then.
+    x1 = random.normal(x1_key, (batch1,) + shape + (num_channels,))
+    x2 = None if same_input else random.normal(
+        x2_key, (batch2,) + shape + (num_channels,))
     if test_mask:
       mask_constant = 10.
-      key, split1, split2 = random.split(key, 3)
-      mask1 = random.bernoulli(split1, p=0.5, shape=(batch1,) + shape + (1,))
-      x1 = np.where(mask1, mask_constant, x1)
-      if same_input:
-        x2 = x1
-      else:
-        mask2 = random.bernoulli(split2, p=0.5, shape=(batch2,) + shape + (1,))
-        x2 = np.where(mask2, mask_constant, x2)
-    key, split1, split2 = random.split(key, 3)
-    pattern1 = random.uniform(split1, (batch1,) + shape * 2)
+      # Draw masks for both batches in a single call.
+      mask = random.bernoulli(mask_key, p=0.5,
+                              shape=(batch1 + batch2,) + shape + (1,))
+      x1 = np.where(mask[:batch1], mask_constant, x1)
+      if not same_input:
+        x2 = np.where(mask[batch1:], mask_constant, x2)
+    pattern1 = random.uniform(pattern1_key, (batch1,) + shape * 2)
     pattern2 = pattern1 if same_input else random.uniform(
-        split2, (batch2,) + shape * 2)
+        pattern2_key, (batch2,) + shape * 2)
 
     # Build the infinite network.
     init_fn, apply_fn, kernel_fn = stax.serial(
@@ -2517,7 +2900,7 @@ class AggregateTest(test_utils.NeuralTangentsTestCase):
 
     kernel_mc_fn = monte_carlo.monte_carlo_kernel_fn(
         init_fn, apply_fn, random.PRNGKey(10), 128,
-        batch_size=2 if xla_bridge.get_backend().platform == 'tpu' else 0,
+        batch_size=2 if _PLATFORM == 'tpu' else 0,
         implementation=2,
     )
     empirical = kernel_mc_fn(x1, x2, get,
@@ -2532,6 +2915,35 @@ class AggregateTest(test_utils.NeuralTangentsTestCase):
 
 class ConvTransposeTest(test_utils.NeuralTangentsTestCase):
 
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def _get_kernel_fns(cls, width, filter_shape, strides, padding,
+                      diagonal_batch, diagonal_spatial, n_samples):
+    """Returns exact and Monte Carlo `kernel_fn`s of `test_conv_transpose`.
+
+    Shared by cases differing only in input `size`. Exact `kernel_fn` is jitted
+    with the diagonalization and `get` arguments bound.
+    """
+    init_fn, apply_fn, kernel_fn = stax.ConvTranspose(width, (filter_shape,),
+                                                      (strides,), padding,
+                                                      b_std=0.1)
+    kernel_fn = jit(functools.partial(
+        kernel_fn,
+        diagonal_batch=diagonal_batch,
+        diagonal_spatial=diagonal_spatial,
+        get='cov1' if diagonal_batch else 'nngp'))
+
+    diagonal_axes = ()
+    if diagonal_batch:
+      diagonal_axes += (0,)
+    if diagonal_spatial:
+      diagonal_axes += (1,)
+
+    kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, apply_fn, _KEY, n_samples, diagonal_axes=diagonal_axes,
+        device_count=0, implementation=2, vmap_axes=0)
+    return kernel_fn, kernel_fn_mc
+
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
           'testcase_name':
@@ -2561,32 +2973,17 @@ class ConvTransposeTest(test_utils.NeuralTangentsTestCase):
     width = 512
     tol = 0.01
     n_samples = 512
-    filter_shape = (filter_shape,)
-    strides = (strides,)
-
-    init_fn, apply_fn, kernel_fn = stax.ConvTranspose(width, filter_shape,
-                                                      strides, padding,
-                                                      b_std=0.1)
 
-    key = random.PRNGKey(1)
+    key = _KEY
     shape = (size, 1)
     x1 = random.normal(key, (2,) + shape)
     x2 = random.normal(key, (3,) + shape) if not same_inputs else None
 
-    k = kernel_fn(x1, x2,
-                  diagonal_batch=diagonal_batch,
-                  diagonal_spatial=diagonal_spatial,
-                  get='cov1' if diagonal_batch else 'nngp')
-
-    diagonal_axes = ()
-    if diagonal_batch:
-      diagonal_axes += (0,)
-    if diagonal_spatial:
-      diagonal_axes += (1,)
-
-    kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, key, n_samples, diagonal_axes=diagonal_axes,
-        device_count=0, implementation=2, vmap_axes=0)
+    kernel_fn, kernel_fn_mc = self._get_kernel_fns(width, filter_shape,
+                                                   strides, padding,
+                                                   diagonal_batch,
+                                                   diagonal_spatial, n_samples)
+    k = kernel_fn(x1, x2)
     k_mc = kernel_fn_mc(x1, None if diagonal_batch else x2, 'nngp')
 
     test_utils.assert_close_matrices(self, k_mc, k, tol)
@@ -2609,14 +3006,14 @@ class ConvTransposeTest(test_utils.NeuralTangentsTestCase):
     assert len(lhs.shape) == len(rhs.shape)
     nspatial = len(lhs.shape) - 2
     dn = lax.conv_dimension_numbers(lhs.shape, rhs.shape, dimension_numbers)
-    in_shape = np.take(lhs.shape, dn.lhs_spec)
+    in_shape = tuple(lhs.shape[i] for i in dn.lhs_spec)
     in_sdims = in_shape[2:]
-    k_shape = np.take(rhs.shape, dn.rhs_spec)
+    k_shape = tuple(rhs.shape[i] for i in dn.rhs_spec)
     o_sdims = [in_sdims[i]*strides[i] for i in range(nspatial)]
     o_shape = [in_shape[0], k_shape[1]] + o_sdims
     out_spec_inv = [x[0] for x in
                     sorted(enumerate(dn.out_spec), key=lambda x: x[1])]
-    o_layout = np.take(np.array(o_shape), out_spec_inv)
+    o_layout = tuple(o_shape[i] for i in out_spec_inv)
     placeholder = np.ones(o_layout, lhs.dtype)
 
     _, apply_fn, _ = stax.Conv(
@@ -2664,7 +3061,7 @@ class ConvTransposeTest(test_utils.NeuralTangentsTestCase):
     if size > 2:
       _skip_test()
 
-    x = random.normal(random.PRNGKey(1), (2, size, 3))
+    x = random.normal(_KEY, (2, size, 3))
     dn = ('NHC', 'HIO', 'NHC')
     padding = 'CIRCULAR'
     filter_shape = (filter_shape,)
@@ -2678,6 +3075,29 @@ class ConvTransposeTest(test_utils.NeuralTangentsTestCase):
     self.assertAllClose(f_adj, f_conv)
 
 
+# Pure arithmetic over small tuples, repeated with the same arguments across the
+# many `test_dot_general` cases.
+_axis_after_dot = functools.lru_cache(maxsize=4096)(utils.axis_after_dot)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_masked_inputs(key_index, shape, p, mask_constant):
+  """Returns `cos` of normal inputs of `shape`, masked with probability `p`.
+
+  Inputs are drawn with `_KEY_SPLIT_3[key_index]` and reused by all cases
+  requesting the same `shape`.
+  """
+  key = _KEY_SPLIT_3[key_index]
+  return _masked_inputs(key, shape, p, mask_constant)
+
+
+@functools.partial(jit, static_argnums=(1,))
+def _masked_inputs(key, shape, p, mask_constant):
+  x = np.cos(random.normal(key, shape))
+  mask = random.bernoulli(key, p=p, shape=shape)
+  return np.where(mask, mask_constant, x)
+
+
 class DotGeneralTest(test_utils.NeuralTangentsTestCase):
 
   @jtu.parameterized.named_parameters(
@@ -2725,7 +3145,10 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
           for contracting_dims in more_itertools.powerset(
               i for i in range(n)
               if i not in batch_dims + (channel_axis,))
-          for c_dims in itertools.permutations(contracting_dims)
+          # Contracting dimension pairs are unordered, so permuting them
+          # (together with their `rhs` counterparts) gives equivalent cases.
+          # Batch dimension order does matter, as it sets the output layout.
+          for c_dims in [contracting_dims]
           for b_dims in itertools.permutations(batch_dims)
           for r_permutation in itertools.permutations(range(n))
       )
@@ -2733,12 +3156,12 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
   def test_dot_general(self, same_inputs, n, batch_dims, contracting_dims,
                        c_dims, b_dims, r_permutation, channel_axis, is_rhs,
                        diagonal_spatial, diagonal_batch, batch_axis):
-    if xla_bridge.get_backend().platform == 'cpu' and n != 2:
+    if _PLATFORM == 'cpu' and n != 2:
       raise absltest.SkipTest(f'Skipping n = {n} on CPU.')
 
     n_b = 2
     n_c = 1
-    key1, key2, key3 = random.split(random.PRNGKey(1), 3)
+    key1, _, _ = _KEY_SPLIT_3
 
     x_shape_n_c = [2, 4, 6, 8, 10, 12, 14][:n - 2]
     x_shape = list(x_shape_n_c)
@@ -2748,9 +3171,7 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
 
     mask_constant = 10.
 
-    x1 = np.cos(random.normal(key1, x_shape))
-    mask1 = random.bernoulli(key1, p=0.8, shape=x1.shape)
-    x1 = np.where(mask1, mask_constant, x1)
+    x1 = _get_masked_inputs(0, tuple(x_shape), 0.8, mask_constant)
 
     if same_inputs:
       x2 = None
@@ -2759,15 +3180,12 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
                   [4 if (batch_axis not in contracting_dims + batch_dims)
                    else x_shape[batch_axis]] +
                   x_shape[batch_axis + 1:])
-      x2 = np.cos(random.normal(key2, x2_shape))
-      mask2 = random.bernoulli(key2, p=0.4, shape=x2.shape)
-      x2 = np.where(mask2, mask_constant, x2)
+      x2 = _get_masked_inputs(1, tuple(x2_shape), 0.4, mask_constant)
 
-    other_shape = [1, 3, 5, 7, 9, 11, 13, 15][:n]
-    for i in contracting_dims + batch_dims:
-      other_shape[i] = x_shape[i]
-    other = random.normal(key3, other_shape)
-    other = np.arange(np.size(other)).reshape(other_shape)
+    other_shape = [x_shape[i] if i in contracting_dims + batch_dims else d
+                   for i, d in enumerate([1, 3, 5, 7, 9, 11, 13, 15][:n])]
+    other = np.arange(int(onp.prod(other_shape)),
+                      dtype=np.float32).reshape(other_shape)
 
     other_t = np.transpose(other, r_permutation)
     r_c_dims = tuple(r_permutation.index(c) for c in c_dims)
@@ -2801,8 +3219,22 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
     else:
       exact = get_exact()
 
-      out_c_axis = utils.axis_after_dot(channel_axis, c_dims, b_dims, lhs_ndim)
-      out_b_axis = utils.axis_after_dot(batch_axis, c_dims, b_dims, lhs_ndim)
+      out_c_axis = _axis_after_dot(channel_axis, c_dims, b_dims, lhs_ndim)
+      out_b_axis = _axis_after_dot(batch_axis, c_dims, b_dims, lhs_ndim)
+
+      # `cov1` and `cov2` share the sampler (and its compiled code).
+      @functools.lru_cache(maxsize=None)
+      def get_kernel_fn_mc(diagonal_axes, device_count):
+        return monte_carlo.monte_carlo_kernel_fn(
+            init_fn=init_fn,
+            apply_fn=apply_fn,
+            key=key1,
+            n_samples=1,
+            trace_axes=(out_c_axis,),
+            diagonal_axes=diagonal_axes,
+            device_count=device_count,
+            implementation=2,
+        )
 
       def get_empirical(get):
         def get_diagonal_axes():
@@ -2814,12 +3246,12 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
 
           if diagonal_spatial:
             axes += tuple(
-                utils.axis_after_dot(i, c_dims, b_dims, lhs_ndim)
+                _axis_after_dot(i, c_dims, b_dims, lhs_ndim)
                 for i in range(n)
                 if i not in c_dims + (batch_axis, channel_axis))
             rhs_ndim = None if rhs is None else rhs.ndim
             axes += tuple(
-                utils.axis_after_dot(i, r_c_dims, r_b_dims, rhs_ndim)
+                _axis_after_dot(i, r_c_dims, r_b_dims, rhs_ndim)
                 for i in range(n)
                 if i not in r_c_dims and
                 not (i in r_b_dims and b_dims[r_b_dims.index(i)] == batch_axis))
@@ -2839,18 +3271,11 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
             return (axis,), (0,)
           return (axis, axis + 1), (0, 1)
 
-        kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-            init_fn=init_fn,
-            apply_fn=apply_fn,
-            key=key1,
-            n_samples=1,
-            trace_axes=(out_c_axis,),
+        kernel_fn_mc = get_kernel_fn_mc(
             diagonal_axes=get_diagonal_axes(),
             device_count=-1 if (get == 'nngp' and
                                 batch_axis == out_b_axis == 0 and
-                                0 not in c_dims + b_dims) else 0,
-            implementation=2,
-        )
+                                0 not in c_dims + b_dims) else 0)
 
         empirical = kernel_fn_mc(x1=x2 if get == 'cov2' else x1,
                                  x2=x2 if get == 'nngp' else None,
@@ -2897,27 +3322,23 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
   )
   def test_dot_general_nn(self, same_inputs, get, n, is_rhs, do_pool,
                           dot_first):
-    if xla_bridge.get_backend().platform == 'cpu' and n != 2:
+    if _PLATFORM == 'cpu' and n != 2:
       raise absltest.SkipTest(f'Skipping n = {n} on CPU.')
 
     width = 2**8
     n_samples = 2**8
     tol = 0.03
-    key1, key2, key3 = random.split(random.PRNGKey(1), 3)
+    key1, _, key3 = _KEY_SPLIT_3
 
     mask_constant = 10.
 
     x_shape = [6, 3, 4, 5][:n - 1] + [1]
-    x1 = np.cos(random.normal(key1, x_shape))
-    mask1 = random.bernoulli(key1, p=0.8, shape=x1.shape)
-    x1 = np.where(mask1, mask_constant, x1)
+    x1 = _get_masked_inputs(0, tuple(x_shape), 0.8, mask_constant)
 
     if same_inputs:
       x2 = None
     else:
-      x2 = np.cos(random.normal(key2, x_shape))
-      mask2 = random.bernoulli(key2, p=0.4, shape=x2.shape)
-      x2 = np.where(mask2, mask_constant, x2)
+      x2 = _get_masked_inputs(1, tuple(x_shape), 0.4, mask_constant)
 
     other = random.normal(key3, [3, 4, 6, 2])
 
@@ -2969,11 +3390,13 @@ class DotGeneralTest(test_utils.NeuralTangentsTestCase):
 
     mask_constant = 10.
 
+    k_fn = stax.DotGeneral(
+        rhs=np.ones(x1.shape[:-1]),
+        dimension_numbers=(((1,), (1,)), ((2,), (2,))))[2]
+
+    @jit
     def get_k(x1, x2, m1, m2):
       x1, x2 = np.where(m1, mask_constant, x1), np.where(m2, mask_constant, x2)
-      k_fn = stax.DotGeneral(
-          rhs=np.ones(x1.shape[:-1]),
-          dimension_numbers=(((1,), (1,)), ((2,), (2,))))[2]
       k = k_fn(x1, x2, 'nngp', mask_constant=mask_constant)
       return k
 
@@ -3008,7 +3431,7 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
   def test_whitened_inputs(self, diagonal_spatial):
     _skip_test()
 
-    x = np.cos(random.normal(random.PRNGKey(1), (4 * 8 * 8, 512)))
+    x = np.cos(random.normal(_KEY, (4 * 8 * 8, 512)))
     cov = x @ x.T
     whiten = np.linalg.cholesky(np.linalg.inv(cov))
     x_white = whiten.T @ x
@@ -3042,6 +3465,47 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
     else:
       self._test_against_mc(apply_fn, init_fn, k.nngp, x, None)
 
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def _get_conv_local_kernel_fns(cls, filter_shape, strides, padding,
+                                 parameterization, diagonal_batch,
+                                 diagonal_spatial):
+    """Returns `kernel_fn`s of `test_conv_local`, shared across `get`/`size`.
+
+    Returns jitted exact `ConvLocal` and `Conv` `kernel_fn`s with the
+    diagonalization arguments bound, and a Monte Carlo `ConvLocal` `kernel_fn`.
+    """
+    kernel_kwargs = dict(diagonal_batch=diagonal_batch,
+                         diagonal_spatial=diagonal_spatial)
+
+    conv_kwargs = dict(out_chan=512,
+                       filter_shape=(filter_shape,),
+                       strides=(strides,),
+                       padding=padding,
+                       b_std=0.2,
+                       W_std=1.5,
+                       parameterization=parameterization)
+
+    init_fn, apply_fn, kernel_fn = stax.ConvLocal(**conv_kwargs)
+    _, _, kernel_fn_conv = stax.Conv(**conv_kwargs)
+
+    diagonal_axes = ()
+    if diagonal_batch:
+      diagonal_axes += (0,)
+    if diagonal_spatial:
+      diagonal_axes += (1,)
+
+    _, _, key_mc = _KEY_SPLIT_3
+    kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, apply_fn, key_mc, n_samples=512, diagonal_axes=diagonal_axes,
+        device_count=0,
+        implementation=2,
+        vmap_axes=0
+    )
+    return (jit(functools.partial(kernel_fn, **kernel_kwargs)),
+            kernel_fn_mc,
+            jit(functools.partial(kernel_fn_conv, **kernel_kwargs)))
+
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
           'testcase_name':
@@ -3076,45 +3540,26 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
     if diagonal_batch and get != 'cov1':
       raise absltest.SkipTest('Checking `diagonal_batch` only on `cov1`.')
 
-    key1, key2, key_mc = random.split(random.PRNGKey(1), 3)
+    key1, key2, _ = _KEY_SPLIT_3
     shape = (size, 1)
     x1 = random.normal(key1, (2,) + shape)
     x2 = random.normal(key2, (3,) + shape) if not same_inputs else None
 
-    kernel_kwargs = dict(diagonal_batch=diagonal_batch,
-                         diagonal_spatial=diagonal_spatial)
-
-    conv_kwargs = dict(out_chan=512,
-                       filter_shape=(filter_shape,),
-                       strides=(strides,),
-                       padding=padding,
-                       b_std=0.2,
-                       W_std=1.5,
-                       parameterization=parameterization)
-
-    init_fn, apply_fn, kernel_fn = stax.ConvLocal(**conv_kwargs)
-    k = kernel_fn(x1, x2, **kernel_kwargs)
-
-    # Compared to MC estimate
-    diagonal_axes = ()
-    if diagonal_batch:
-      diagonal_axes += (0,)
-    if diagonal_spatial:
-      diagonal_axes += (1,)
+    kernel_fn, kernel_fn_mc, kernel_fn_conv = self._get_conv_local_kernel_fns(
+        filter_shape, strides, padding, parameterization, diagonal_batch,
+        diagonal_spatial)
+    k = kernel_fn(x1, x2)
 
-    kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, key_mc, n_samples=512, diagonal_axes=diagonal_axes,
-        device_count=0,
-        implementation=2,
-        vmap_axes=0
-    )
-    k_mc = kernel_fn_mc(x1, None if get == 'cov1' else x2,
-                        'nngp' if get == 'cov1' else get)
-    test_utils.assert_close_matrices(self, k_mc, getattr(k, get), 0.011)
+    # Compared to MC estimate. With `diagonal_spatial=True` the whole kernel is
+    # also compared exactly against the CNN below, so by default only sample one
+    # parameterization.
+    if _RUN_MC or not diagonal_spatial or parameterization == 'standard':
+      k_mc = kernel_fn_mc(x1, None if get == 'cov1' else x2,
+                          'nngp' if get == 'cov1' else get)
+      test_utils.assert_close_matrices(self, k_mc, getattr(k, get), 0.011)
 
     # Compared diagonal entries to CNN
-    _, _, kernel_fn_conv = stax.Conv(**conv_kwargs)
-    k_conv = kernel_fn_conv(x1, x2, **kernel_kwargs)
+    k_conv = kernel_fn_conv(x1, x2)
 
     if not diagonal_spatial:
       def get_diag(k):
@@ -3124,9 +3569,27 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
       k_conv = get_diag(k_conv)
       k = get_diag(k)
 
-    tol = 0.005 if xla_bridge.get_backend().platform == 'tpu' else 0.001
+    tol = 0.005 if _PLATFORM == 'tpu' else 0.001
     self.assertAllClose(k_conv, k, atol=tol, rtol=tol)
 
+  @classmethod
+  @functools.lru_cache(maxsize=None)
+  def _get_deep_nn(cls, conv, pool, readout, parameterization, get):
+    """Returns the `test_conv_local_deep` network, built once per config."""
+    width = 256
+    return stax.serial(
+        conv(width, (2, 3), (2, 1), padding='CIRCULAR', W_std=1.5, b_std=0.2,
+             parameterization=parameterization),
+        pool,
+        stax.Erf(),
+        conv(width, (3, 1), (1, 2), padding='SAME'),
+        stax.Relu(),
+        conv(width, (2, 3), (2, 1), padding='VALID', W_std=1.2, b_std=0.3,
+             parameterization=parameterization),
+        readout,
+        stax.Dense(1 if get == 'ntk' else width)
+    )
+
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
           'testcase_name':
@@ -3152,25 +3615,12 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
                            parameterization):
     _skip_test()
 
-    key1, key2, key_mc = random.split(random.PRNGKey(1), 3)
+    key1, key2, key_mc = _KEY_SPLIT_3
     x1 = random.normal(key1, (2, 7, 8, 3))
     x2 = random.normal(key2, (3, 7, 8, 3)) if not same_inputs else None
 
-    def get_nn(conv):
-      width = 256
-      return stax.serial(
-          conv(width, (2, 3), (2, 1), padding='CIRCULAR', W_std=1.5, b_std=0.2,
-               parameterization=parameterization),
-          pool,
-          stax.Erf(),
-          conv(width, (3, 1), (1, 2), padding='SAME'),
-          stax.Relu(),
-          conv(width, (2, 3), (2, 1), padding='VALID', W_std=1.2, b_std=0.3,
-               parameterization=parameterization),
-          readout,
-          stax.Dense(1 if get == 'ntk' else width)
-      )
-
+    get_nn = functools.partial(self._get_deep_nn, pool=pool, readout=readout,
+                               parameterization=parameterization, get=get)
     init_fn, apply_fn, kernel_fn_local = get_nn(stax.ConvLocal)
 
     k_local = kernel_fn_local(x1, x2, get)
@@ -3186,24 +3636,28 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
           test_utils.assert_close_matrices(self, k_local, k_local_d, 0.01)
 
     # Test against CNN-GP diagonal if only flattening is used.
-    if pool[0].__name__ == 'Identity' and readout[0].__name__ == 'Flatten':
+    is_conv_gp = (pool[0].__name__ == 'Identity' and
+                  readout[0].__name__ == 'Flatten')
+    if is_conv_gp:
       _, _, kernel_fn_conv = get_nn(stax.Conv)
       k_conv = kernel_fn_conv(x1, x2, get)
       self.assertAllClose(k_conv, k_local)
 
-    # Test against MC.
-    kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, key_mc, n_samples=512, device_count=0,
-        implementation=2,
-        vmap_axes=0
-    )
-    k_mc = kernel_fn_mc(x1, x2, get)
-    test_utils.assert_close_matrices(self, k_mc, k_local, 0.015)
+    # Test against MC. Kernels matched exactly to the CNN-GP above are by
+    # default only sampled for one parameterization.
+    if _RUN_MC or not is_conv_gp or parameterization == 'standard':
+      kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
+          init_fn, apply_fn, key_mc, n_samples=512, device_count=-1,
+          implementation=2,
+          vmap_axes=0
+      )
+      k_mc = kernel_fn_mc(x1, x2, get)
+      test_utils.assert_close_matrices(self, k_mc, k_local, 0.015)
 
   def test_conv_local_conv(self):
     _skip_test(platforms=('cpu', 'tpu'))
 
-    key1, key2 = random.split(random.PRNGKey(1), 2)
+    key1, key2 = _KEY_SPLIT
     x1 = np.cos(random.normal(key1, (5, 32, 32, 1)))
     x2 = np.sin(random.normal(key2, (5, 32, 32, 1)))
 
@@ -3223,26 +3677,27 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
     init_fn, apply_fn, kernel_fn = local_conv
 
     # No projection layer
-    k = kernel_fn(x1, x2)
+    k_jit = jit(lambda x1, x2: kernel_fn(x1, x2))
+    k = k_jit(x1, x2)
     self.assertEqual(k.diagonal_spatial, False)
     self._test_against_mc(apply_fn, init_fn, k.reverse().nngp, x1, x2, 0.03)
 
+    def get_nngp_timed(kernel_fn):
+      k_jit = jit(lambda x1, x2: kernel_fn(x1, x2))
+      # `x1` and `x2` have equal shapes, so this compiles the timed executable.
+      k_jit(x2, x1).nngp.block_until_ready()
+      start = time.time()
+      k = k_jit(x1, x2).nngp.block_until_ready()
+      return k, time.time() - start
+
     # Top layer flat
     init_fn, apply_fn, kernel_fn = stax.serial(local_conv, stax.Flatten())
-    k_jit = jit(lambda x1, x2: kernel_fn(x1, x2))
-    k_jit(x2, x1).nngp.block_until_ready()
-    time_flat = time.time()
-    k = k_jit(x1, x2).nngp.block_until_ready()
-    time_flat = time.time() - time_flat
+    k, time_flat = get_nngp_timed(kernel_fn)
     self._test_against_mc(apply_fn, init_fn, k, x1, x2, 0.03)
 
     # Top layer pooling
     init_fn, apply_fn, kernel_fn = stax.serial(local_conv, stax.GlobalAvgPool())
-    k_jit = jit(lambda x1, x2: kernel_fn(x1, x2))
-    k_jit(x2, x1).nngp.block_until_ready()
-    time_pool = time.time()
-    k = k_jit(x1, x2).nngp.block_until_ready()
-    time_pool = time.time() - time_pool
+    k, time_pool = get_nngp_timed(kernel_fn)
     self.assertLess(time_flat * 5, time_pool)
     self._test_against_mc(apply_fn, init_fn, k, x1, x2, 0.03)
 
@@ -3251,18 +3706,14 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
                                                stax.ConvLocal(width, (2, 2),
                                                               padding='SAME'),
                                                stax.GlobalAvgPool())
-    k_jit = jit(lambda x1, x2: kernel_fn(x1, x2))
-    k_jit(x2, x1).nngp.block_until_ready()
-    time_lcn_pool = time.time()
-    k = k_jit(x1, x2).nngp.block_until_ready()
-    time_lcn_pool = time.time() - time_lcn_pool
+    k, time_lcn_pool = get_nngp_timed(kernel_fn)
     self.assertLess(time_lcn_pool * 5, time_pool)
     self._test_against_mc(apply_fn, init_fn, k, x1, x2, 0.03)
 
   def test_double_pool(self):
     _skip_test()
 
-    key1, key2 = random.split(random.PRNGKey(1), 2)
+    key1, key2 = _KEY_SPLIT
     x1 = np.cos(random.normal(key1, (2, 4, 6, 3)))
     x2 = np.sin(random.normal(key2, (3, 4, 6, 3)))
 
@@ -3283,7 +3734,8 @@ class ConvLocalTest(test_utils.NeuralTangentsTestCase):
 
   def _test_against_mc(self, apply_fn, init_fn, k, x1, x2, tol=0.01, n=256):
     kernel_fn_mc = monte_carlo.monte_carlo_kernel_fn(
-        init_fn, apply_fn, random.PRNGKey(2), n_samples=n, device_count=0,
+        init_fn, _get_mc_apply_fn(apply_fn), random.PRNGKey(2), n_samples=n,
+        device_count=0,
         implementation=2,
         vmap_axes=0
     )